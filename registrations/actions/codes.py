@@ -1,19 +1,76 @@
 import base64
 import hmac
+import os
+import tempfile
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 import binascii
-from hashlib import sha1
+from functools import lru_cache
+from hashlib import sha1, sha256
+from io import BytesIO
+from typing import NamedTuple
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 import qrcode
+from qrcode.image.svg import SvgPathImage
+
+QRCODE_CACHE_SIZE = 2048
 
 
 class InvalidCodeException(Exception):
     pass
 
 
+class Signer:
+    """
+    Sign with the newest key and verify against every active key.
+
+    The HMAC objects are keyed once, and copied for each message.
+    """
+
+    def __init__(self, keys):
+        self._keyed = [hmac.new(key=key, digestmod=sha1) for key in keys]
+
+    def _digest(self, keyed, msg):
+        h = keyed.copy()
+        h.update(msg)
+        return h.digest()
+
+    def sign(self, msg):
+        return self._digest(self._keyed[0], msg)
+
+    def signatures(self, msg):
+        """Signatures of the message with every active key, newest first"""
+        return [self._digest(keyed, msg) for keyed in self._keyed]
+
+    def verify(self, msg, signature):
+        # compare against all keys to avoid leaking which one matched
+        valid = False
+        for keyed in self._keyed:
+            valid |= hmac.compare_digest(signature, self._digest(keyed, msg))
+        return valid
+
+
+_signer = None
+
+
+def get_signer():
+    global _signer
+    if _signer is None:
+        _signer = Signer([settings.SIGNATURE_KEY, *settings.SIGNATURE_OLD_KEYS])
+    return _signer
+
+
+@receiver(setting_changed)
+def reset_signer(setting, **kwargs):
+    global _signer
+    if setting in ("SIGNATURE_KEY", "SIGNATURE_OLD_KEYS"):
+        _signer = None
+
+
 def gen_signature(msg):
-    return hmac.new(key=settings.SIGNATURE_KEY, msg=msg, digestmod=sha1).digest()
+    return get_signer().sign(msg)
 
 
 def gen_signed_message(object_id):
@@ -29,15 +86,73 @@ def gen_qrcode(object_id):
 
     return qrcode.make(full_msg, border=0)
 
+
+class QRCodeSVG(NamedTuple):
+    path: str  # path data, in modules
+    size: int  # number of modules on each side
+
+
+def _qrcode_store_path(message, extension):
+    return os.path.join(
+        settings.MEDIA_ROOT, "qrcodes", sha256(message).hexdigest() + extension
+    )
+
+
+@lru_cache(maxsize=QRCODE_CACHE_SIZE)
+def _qrcode_png(message):
+    if settings.QRCODE_DISK_CACHE:
+        path = _qrcode_store_path(message, ".png")
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+    img_data = BytesIO()
+    qrcode.make(message, border=0).save(img_data, "PNG")
+    png = img_data.getvalue()
+
+    if settings.QRCODE_DISK_CACHE:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename so that concurrent readers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(png)
+        os.replace(tmp_path, path)
+
+    return png
+
+
+@lru_cache(maxsize=QRCODE_CACHE_SIZE)
+def _qrcode_svg(message):
+    img = qrcode.make(message, border=0, image_factory=SvgPathImage)
+    return QRCodeSVG(path=img.path.get("d"), size=img.width)
+
+
+def qrcode_png(object_id):
+    """
+    PNG bytes of the QR code of an object.
+
+    The signed message being deterministic, images are kept in a LRU cache and,
+    when QRCODE_DISK_CACHE is set, stored under MEDIA_ROOT/qrcodes.
+    """
+    return _qrcode_png(gen_signed_message(object_id))
+
+
+def qrcode_svg(object_id):
+    """SVG path of the QR code of an object, kept in a LRU cache"""
+    return _qrcode_svg(gen_signed_message(object_id))
+
+
 def gen_pk_signature_qrcode(object_id: str) -> str:
     msg = str(object_id).encode("utf-8")
     signature = gen_signature(msg)
     b64_signature = urlsafe_b64encode(signature).rstrip(b"=")  # éviter les `=`
     return f"{object_id}.{b64_signature.decode('utf-8')}"
 
+
 def check_signature(msg, signature):
-    correct_signature = gen_signature(msg)
-    return hmac.compare_digest(signature, correct_signature)
+    return get_signer().verify(msg, signature)
 
 
 def get_id_from_code(code):
@@ -53,13 +168,15 @@ def get_id_from_code(code):
         try:
             identifier, base64_signature = s.split(".")
         except ValueError:
-            raise InvalidCodeException("There should be exactly one separator period point")
+            raise InvalidCodeException(
+                "There should be exactly one separator period point"
+            )
         return identifier, base64_signature
 
     # 1) Essayer de décoder base64url complet (cas Google Wallet)
     try:
-        padding = '=' * (-len(code) % 4)
-        decoded = urlsafe_b64decode(code + padding).decode('utf-8')
+        padding = "=" * (-len(code) % 4)
+        decoded = urlsafe_b64decode(code + padding).decode("utf-8")
         # Si décodage réussi, on considère que c'est le format Wallet
         identifier, base64_signature = decode_and_split(decoded)
     except (binascii.Error, ValueError):
@@ -72,7 +189,7 @@ def get_id_from_code(code):
         raise InvalidCodeException("The identifier should be an integer")
 
     try:
-        sig_padding = '=' * (-len(base64_signature) % 4)
+        sig_padding = "=" * (-len(base64_signature) % 4)
         signature = urlsafe_b64decode(base64_signature + sig_padding)
     except (binascii.Error, ValueError):
         raise InvalidCodeException("Incorrect base64 signature")
@@ -81,3 +198,64 @@ def get_id_from_code(code):
         raise InvalidCodeException("Incorrect signature")
 
     return object_id
+
+
+REASON_FORMAT = "format"
+REASON_IDENTIFIER = "identifier"
+REASON_BASE64 = "base64"
+REASON_SIGNATURE = "signature"
+
+
+def verify_codes(codes):
+    """
+    Verify many codes (strings) at once, in raw or wallet format.
+
+    The HMAC states of the signer are only copied for each code. A code
+    containing a period is in raw format, as the urlsafe base64 alphabet of the
+    wallet format has none.
+
+    Returns a dict of valid codes to their identifier, and a dict of rejected
+    codes to the reason of the rejection (one of the REASON_* constants).
+    """
+    signer = get_signer()
+    valid = {}
+    rejected = {}
+
+    for code in codes:
+        if code in valid or code in rejected:
+            continue
+
+        if "." not in code:
+            try:
+                code_bytes = urlsafe_b64decode(code + "=" * (-len(code) % 4))
+            except (binascii.Error, ValueError):
+                rejected[code] = REASON_FORMAT
+                continue
+        else:
+            code_bytes = code.encode("utf8")
+
+        parts = code_bytes.split(b".")
+        if len(parts) != 2:
+            rejected[code] = REASON_FORMAT
+            continue
+        identifier, base64_signature = parts
+
+        if not identifier.isdigit():
+            rejected[code] = REASON_IDENTIFIER
+            continue
+
+        try:
+            signature = urlsafe_b64decode(
+                base64_signature + b"=" * (-len(base64_signature) % 4)
+            )
+        except (binascii.Error, ValueError):
+            rejected[code] = REASON_BASE64
+            continue
+
+        if not signer.verify(identifier, signature):
+            rejected[code] = REASON_SIGNATURE
+            continue
+
+        valid[code] = int(identifier)
+
+    return valid, rejected
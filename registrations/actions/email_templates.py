@@ -0,0 +1,130 @@
+"""
+Local rendering of the Mosaico email templates.
+
+The template server used to be called for each email with the personal fields
+as query parameters. It is now called once per template URL with placeholder
+tokens instead of the values, and the tokens are then replaced locally. Fetched
+templates are kept EMAIL_TEMPLATE_TTL seconds, then revalidated with their
+ETag; if the server cannot be reached, the stale copy keeps being used.
+"""
+
+import logging
+import re
+import threading
+from collections import defaultdict
+from time import monotonic
+
+import requests
+from django.conf import settings
+from django.utils.html import escape
+
+from . import http
+
+logger = logging.getLogger(__name__)
+
+_cache = {}
+_locks = defaultdict(threading.Lock)
+_locks_lock = threading.Lock()
+
+
+def placeholder(name):
+    # only made of characters that no template engine nor URL encoding alters
+    return f"__SCANNER_{name}__"
+
+
+class EmailTemplate:
+    def __init__(self, html, names):
+        self.html = html
+        tokens = {placeholder(name): name for name in names}
+        self.names = {name for token, name in tokens.items() if token in html}
+        self._tokens = tokens
+        self._pattern = (
+            re.compile("|".join(re.escape(placeholder(name)) for name in self.names))
+            if self.names
+            else None
+        )
+
+    def uses(self, name):
+        return name in self.names
+
+    def render(self, values):
+        """Replace the placeholders by the HTML escaped values, in one pass"""
+        if self._pattern is None:
+            return self.html
+        return self._pattern.sub(
+            lambda match: escape(values.get(self._tokens[match.group(0)], "")),
+            self.html,
+        )
+
+
+class _CachedTemplate:
+    def __init__(self, template, etag, fetched_at):
+        self.template = template
+        self.etag = etag
+        self.fetched_at = fetched_at
+
+
+def _fetch(url, names, cached):
+    headers = {}
+    if cached is not None and cached.etag:
+        headers["If-None-Match"] = cached.etag
+
+    response = http.get(
+        url,
+        "email_template",
+        params={name: placeholder(name) for name in names},
+        headers=headers,
+    )
+
+    if response.status_code == 304 and cached is not None:
+        cached.fetched_at = monotonic()
+        return cached
+
+    response.raise_for_status()
+    return _CachedTemplate(
+        EmailTemplate(response.content.decode(), names),
+        response.headers.get("ETag"),
+        monotonic(),
+    )
+
+
+def get_email_template(url, names):
+    """
+    Returns the EmailTemplate at url, fetched with a placeholder for each of
+    the parameter names.
+    """
+    key = (url, frozenset(names))
+
+    cached = _cache.get(key)
+    if (
+        cached is not None
+        and monotonic() - cached.fetched_at < settings.EMAIL_TEMPLATE_TTL
+    ):
+        return cached.template
+
+    # one lock per URL: no more of them than of templates in the cache
+    with _locks_lock:
+        lock = _locks[url]
+
+    with lock:
+        # another thread may have fetched it while we were waiting
+        cached = _cache.get(key)
+        if (
+            cached is not None
+            and monotonic() - cached.fetched_at < settings.EMAIL_TEMPLATE_TTL
+        ):
+            return cached.template
+
+        try:
+            _cache[key] = _fetch(url, names, cached)
+        except requests.RequestException:
+            if cached is None:
+                raise
+            logger.warning("Could not revalidate email template %s", url, exc_info=True)
+            cached.fetched_at = monotonic()
+
+    return _cache[key].template
+
+
+def clear_cache():
+    _cache.clear()
@@ -1,21 +1,34 @@
 import random
 import string
+import threading
+from collections import defaultdict
+from functools import cached_property
+from email import encoders
+from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
-from io import BytesIO
+from email.mime.text import MIMEText
 
 import html2text
-import requests
 from django.core import mail
+from django.core.mail.message import DEFAULT_ATTACHMENT_MIME_TYPE
 from django.utils.text import slugify
 from django.conf import settings
+from django.utils import timezone
 
 from prometheus_client import Counter
 
-from .tickets import gen_ticket, gen_event_ics
-
-_h = html2text.HTML2Text()
-_h.ignore_images = True
+from .codes import qrcode_png
+from .email_templates import get_email_template
+from .tickets import (
+    gen_event_ics,
+    gen_event_ics_skeleton,
+    gen_ticket,
+    get_template_version,
+    get_ticket_template,
+)
+from .wallet import MAX_GROUP_SIZE, get_google_wallet_signer
+from ..models import Registration
 
 email_sent_counter = Counter("scanner_email_sent", "Number of emails sent")
 
@@ -27,7 +40,146 @@ class RelatedEmailMultiAlternatives(mail.EmailMultiAlternatives):
             msg.set_type('multipart/related')
         return msg
 
-def envoyer_email(
+class AttachmentBundle:
+    """
+    Attachments of an event, read once and encoded as MIME parts that can be
+    shared by all the emails of a send.
+    """
+
+    def __init__(self, event):
+        self.parts = []
+        for attachment in event.attachments.all():
+            with attachment.file.open("rb") as f:
+                content = f.read()
+            self.parts.append(
+                self.mime_part(attachment.filename, content, attachment.mimetype)
+            )
+
+    @staticmethod
+    def mime_part(filename, content, mimetype):
+        maintype, subtype = mimetype.split("/", 1)
+        if maintype == "text":
+            try:
+                content = content.decode()
+            except UnicodeDecodeError:
+                # as Django does for attachments that are not UTF-8
+                maintype, subtype = DEFAULT_ATTACHMENT_MIME_TYPE.split("/", 1)
+
+        if maintype == "text":
+            part = MIMEText(content, subtype, "utf-8")
+        else:
+            part = MIMEBase(maintype, subtype)
+            part.set_payload(content)
+            encoders.encode_base64(part)
+
+        try:
+            filename.encode("ascii")
+        except UnicodeEncodeError:
+            filename = ("utf-8", "", filename)
+        part.add_header("Content-Disposition", "attachment", filename=filename)
+        return part
+
+
+class SendContext:
+    """
+    Everything needed to send the tickets of an event that does not depend on
+    the registration, built once per event and send.
+
+    It is created by the thread reading the registrations, which also loads
+    the attachments from the database; the other members are built on first
+    use and may then be shared by render workers.
+    """
+
+    def __init__(self, event):
+        self.event = event
+        self.template_version = get_template_version(event)
+        self.attachments = AttachmentBundle(event)
+        self._email_templates = {}
+        self._google_wallet_links = {}
+        self._lock = threading.Lock()
+
+    @cached_property
+    def ticket_template(self):
+        return get_ticket_template(self.event, self.template_version)
+
+    @cached_property
+    def ics_skeleton(self):
+        return gen_event_ics_skeleton(self.event)
+
+    @cached_property
+    def google_wallet_signer(self):
+        return get_google_wallet_signer()
+
+    @cached_property
+    def contact_email_groups(self):
+        """Ids of the registrations of the event by lowercased contact email"""
+        groups = defaultdict(list)
+        for pk, contact_emails in (
+            Registration.objects.filter(event=self.event, canceled=False)
+            .order_by("pk")
+            .values_list("pk", "_contact_emails")
+        ):
+            for contact_email in contact_emails.split(",") if contact_emails else []:
+                groups[contact_email.lower()].append(pk)
+        return groups
+
+    def google_wallet_url(self, registration, contact_email):
+        """
+        Link saving all the tickets of the event sent to contact_email, signed
+        once per address, or the link of the registration alone if the group
+        is too big or the registration is not part of it.
+        """
+        group = self.contact_email_groups.get(contact_email.lower(), [])
+        if registration.pk not in group or len(group) > MAX_GROUP_SIZE:
+            return registration.get_google_wallet_url(self.google_wallet_signer)
+
+        key = contact_email.lower()
+        with self._lock:
+            link = self._google_wallet_links.get(key)
+        if link is not None:
+            return link
+
+        # signed outside of the lock: two workers may sign the same group at
+        # the same time, the first link stored is then used by both
+        registrations = Registration.objects.filter(pk__in=group).select_related(
+            "event", "category"
+        )
+        link = self.google_wallet_signer.save_url(
+            [r.google_wallet_object() for r in registrations.order_by("pk")]
+        )
+        with self._lock:
+            return self._google_wallet_links.setdefault(key, link)
+
+    def email_template(self, category, names):
+        """Email template of the category, looked up once during the send"""
+        key = (category.pk, frozenset(names))
+        if key not in self._email_templates:
+            self._email_templates[key] = get_email_template(
+                category.mosaico_url or self.event.mosaico_url, names
+            )
+        return self._email_templates[key]
+
+
+class SendContexts:
+    """Builds the SendContext of each event once during a send"""
+
+    def __init__(self):
+        self._contexts = {}
+
+    def get(self, event):
+        if event.pk not in self._contexts:
+            self._contexts[event.pk] = SendContext(event)
+        return self._contexts[event.pk]
+
+
+def html_to_text(html):
+    # HTML2Text instances are stateful, use one per conversion to stay thread safe
+    h = html2text.HTML2Text()
+    h.ignore_images = True
+    return h.handle(html)
+
+
+def preparer_email(
     recipient, subject, body, html_body=None, connection=None, attachments=None
 ):
     if attachments is None:
@@ -51,10 +203,32 @@ def envoyer_email(
             mimetype=mime_type,
         )
 
-    msg.send()
+    return msg
 
 
-def envoyer_billet(registration, connection=None):
+def envoyer_email(
+    recipient, subject, body, html_body=None, connection=None, attachments=None
+):
+    preparer_email(
+        recipient=recipient,
+        subject=subject,
+        body=body,
+        html_body=html_body,
+        connection=connection,
+        attachments=attachments,
+    ).send()
+
+
+def preparer_billet(registration, connection=None, context=None):
+    """
+    Render the ticket and build one email per contact address, without sending.
+
+    `context` is the SendContext of the event, built here if not given: pass
+    it when sending many tickets.
+    """
+    if context is None:
+        context = SendContext(registration.event)
+
     if registration.ticket_status == registration.TICKET_MODIFIED:
         subject = (
             registration.event.name
@@ -64,33 +238,43 @@ def envoyer_billet(registration, connection=None):
     else:
         subject = registration.event.name + " : billet de " + registration.full_name
 
-    ticket = gen_ticket(registration)
+    ticket = gen_ticket(registration, context=context)
 
     # Génération ICS
-    ics_content = gen_event_ics(registration)
+    ics_content = gen_event_ics(registration, context.ics_skeleton)
 
-    for contact_email in registration.contact_emails:
-        template_url = (
-            registration.category.mosaico_url or registration.event.mosaico_url
-        )
+    values = {
+        "FULL_NAME": registration.full_name,
+        "CATEGORY": registration.category.name,
+        "GOOGLE_WALLET_URL": "",
+        "APPLE_WALLET_URL": "",
+        **{"META_" + k.upper(): v for k, v in registration.meta_values.items()},
+    }
+    template = context.email_template(
+        registration.category, [*values, "EMAIL", "QR_CODE"]
+    )
+
+    # the wallet links are costly to build, only do it when they are displayed
+    google_wallet = registration.event.wallet_logo and template.uses(
+        "GOOGLE_WALLET_URL"
+    )
+    if registration.event.wallet_logo:
+        if template.uses("APPLE_WALLET_URL"):
+            values["APPLE_WALLET_URL"] = (
+                f"https://{settings.BASE_URL}{registration.apple_wallet_url}"
+            )
 
+    messages = []
+    for contact_email in registration.contact_emails:
         qr_code_cid = "".join(random.choices(string.ascii_lowercase + string.digits, k=10))
-        html_message = requests.get(
-            template_url,
-            params={
-                "FULL_NAME": registration.full_name,
-                "EMAIL": contact_email,
-                "CATEGORY": registration.category.name,
-                "QR_CODE": f"cid:{qr_code_cid}",
-                "GOOGLE_WALLET_URL": registration.google_wallet_url if registration.event.wallet_logo else "",
-                "APPLE_WALLET_URL": f"https://{settings.BASE_URL}{registration.apple_wallet_url}" if registration.event.wallet_logo else "",
-                **{
-                    "META_" + p.property.upper(): p.value
-                    for p in registration.metas.all()
-                },
-            },
-        ).content.decode()
-        text_message = _h.handle(html_message)
+        if google_wallet:
+            values["GOOGLE_WALLET_URL"] = context.google_wallet_url(
+                registration, contact_email
+            )
+        html_message = template.render(
+            {**values, "EMAIL": contact_email, "QR_CODE": f"cid:{qr_code_cid}"}
+        )
+        text_message = html_to_text(html_message)
 
         attachments = [
             (
@@ -106,32 +290,51 @@ def envoyer_billet(registration, connection=None):
         ]
 
         if qr_code_cid in html_message:
-            qr_code = BytesIO()
-            registration.qrcode.save(qr_code, "PNG")
-            attachment = MIMEImage(qr_code.getvalue(), "png")
+            attachment = MIMEImage(qrcode_png(registration.pk), "png")
             attachment.add_header("Content-ID", qr_code_cid)
 
             attachments.append((
                 (attachment, None, None)
             ))
 
-        for attachment in registration.event.attachments.all():
-            with attachment.file.open("rb") as f:
-                content = f.read()
-            attachments.append((attachment.filename, content, attachment.mimetype))
-
-        envoyer_email(
-            subject=subject,
-            recipient=contact_email,
-            body=text_message,
-            html_body=html_message,
-            attachments=attachments,
-            connection=connection,
+        # shared MIME parts, attached as is to every email
+        attachments.extend((part, None, None) for part in context.attachments.parts)
+
+        messages.append(
+            preparer_email(
+                subject=subject,
+                recipient=contact_email,
+                body=text_message,
+                html_body=html_message,
+                attachments=attachments,
+                connection=connection,
+            )
         )
 
+    return messages
+
+
+def marquer_billet_envoye(registration):
     if registration.ticket_status != registration.TICKET_SENT:
         registration.ticket_status = registration.TICKET_SENT
         registration.save()
 
     email_sent_counter.inc()
 
+
+def marquer_billets_envoyes(registration_ids):
+    """Same as marquer_billet_envoye, in a single query for many registrations"""
+    Registration.objects.filter(pk__in=registration_ids).update(
+        ticket_status=Registration.TICKET_SENT, modified=timezone.now()
+    )
+    email_sent_counter.inc(len(registration_ids))
+
+
+def envoyer_billet(registration, connection=None, context=None):
+    for message in preparer_billet(
+        registration, connection=connection, context=context
+    ):
+        message.send()
+
+    marquer_billet_envoye(registration)
+
@@ -0,0 +1,73 @@
+"""
+Shared HTTP client for outbound requests.
+
+A single pooled session per process keeps the connections to the few servers
+we call alive between requests. Every request gets a timeout and idempotent
+ones are retried with an exponential backoff on connection errors and
+temporary server errors.
+"""
+
+import threading
+from time import monotonic
+
+import requests
+from django.conf import settings
+from prometheus_client import Histogram
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+http_request_duration = Histogram(
+    "scanner_http_request_duration_seconds",
+    "Duration of outbound HTTP requests, retries included",
+    ["target", "status"],
+)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = Retry(
+                    total=settings.HTTP_RETRIES,
+                    backoff_factor=0.5,
+                    status_forcelist=RETRY_STATUSES,
+                    allowed_methods=frozenset(["GET", "HEAD"]),
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    max_retries=retry,
+                    pool_connections=settings.HTTP_POOL_SIZE,
+                    pool_maxsize=settings.HTTP_POOL_SIZE,
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+
+    return _session
+
+
+def get(url, target, **kwargs):
+    """
+    GET url with the shared session, `target` labelling the request in the
+    metrics.
+    """
+    kwargs.setdefault(
+        "timeout", (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)
+    )
+
+    status = "error"
+    start = monotonic()
+    try:
+        response = get_session().get(url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        http_request_duration.labels(target, status).observe(monotonic() - start)
@@ -0,0 +1,164 @@
+"""
+Compact ticket manifest allowing scanner devices to validate codes offline.
+
+Each row is `[id, category_id, canceled, entrances, check, ...]` where each
+`check` is the urlsafe base64 of the first 9 bytes of the SHA-256 of an accepted
+signature, one per active signature key. A device decodes the code (raw or
+wallet format), hashes the signature bytes and compares: the signature keys
+themselves never leave the server.
+
+Entrances are counted like on the scan screen: only those recorded after the
+last reset (ScanSeq) of their scan point.
+
+A version is `<last action id>-<timestamp in microseconds>`. Passing it back as
+`since` returns only the registrations modified after that timestamp, having
+entrances or cancels recorded after that action, or having entrances at a scan
+point reset after that timestamp. Deltas contain the full row, so the small
+overlap used to cover transactions committing late is harmless.
+"""
+
+import json
+from base64 import urlsafe_b64encode
+from datetime import datetime, timedelta, timezone as dt_timezone
+from hashlib import sha256
+
+from django.db.models import Count, Exists, Max, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .codes import get_signer
+from ..models import Registration, ScannerAction, ScanSeq
+
+CHUNK_SIZE = 2000
+VERSION_OVERLAP = timedelta(seconds=30)
+
+
+def signature_checks(registration_id):
+    return [
+        urlsafe_b64encode(sha256(signature).digest()[:9]).decode("ascii")
+        for signature in get_signer().signatures(str(registration_id).encode("utf8"))
+    ]
+
+
+def current_version():
+    last_action_id = ScannerAction.objects.aggregate(last=Max("id"))["last"] or 0
+    return f"{last_action_id}-{int(timezone.now().timestamp() * 1_000_000)}"
+
+
+def parse_version(version):
+    """Returns the last action id and the date of a version, or raises ValueError"""
+    last_action_id, timestamp = version.split("-")
+    try:
+        date = datetime.fromtimestamp(int(timestamp) / 1_000_000, tz=dt_timezone.utc)
+    except (OverflowError, OSError):
+        raise ValueError("Timestamp out of range")
+    return int(last_action_id), date
+
+
+def visible_entrances():
+    """
+    Number of entrances of the registration (as an OuterRef) recorded after
+    the last reset of their scan point, as displayed by the scan screen.
+    """
+    return Coalesce(
+        Subquery(
+            ScannerAction.objects.filter(
+                registration_id=OuterRef("id"), type=ScannerAction.TYPE_ENTRANCE
+            )
+            .exclude(
+                Exists(
+                    ScanSeq.objects.filter(
+                        point_id=OuterRef("point_id"), created__gte=OuterRef("time")
+                    )
+                )
+            )
+            .order_by()
+            .values("registration_id")
+            .annotate(count=Count("id"))
+            .values("count")
+        ),
+        0,
+    )
+
+
+def manifest_queryset(event, since=None):
+    qs = Registration.objects.filter(event=event)
+
+    if since is not None:
+        last_action_id, modified = parse_version(since)
+        qs = qs.filter(
+            Q(modified__gte=modified - VERSION_OVERLAP)
+            | Exists(
+                ScannerAction.objects.filter(
+                    registration_id=OuterRef("id"),
+                    type__in=[ScannerAction.TYPE_ENTRANCE, ScannerAction.TYPE_CANCEL],
+                    id__gt=last_action_id,
+                )
+            )
+            # a reset hides the entrances recorded before it at its point
+            | Exists(
+                ScannerAction.objects.filter(
+                    registration_id=OuterRef("id"),
+                    type=ScannerAction.TYPE_ENTRANCE,
+                    point__seqs__created__gte=modified - VERSION_OVERLAP,
+                )
+            )
+        )
+
+    return (
+        qs.annotate(entrances=visible_entrances())
+        .order_by("id")
+        .values_list("id", "category_id", "canceled", "entrances")
+    )
+
+
+def gen_manifest(event, since=None):
+    """
+    Yields the manifest of an event as chunks of JSON.
+
+    Raises ValueError if `since` is not a valid version; the check is done
+    before anything is yielded.
+    """
+    # the version is computed first so that changes made while the rows are
+    # read are part of the next delta
+    version = current_version()
+    qs = manifest_queryset(event, since)
+
+    def chunks():
+        header = {
+            "event": event.id,
+            "version": version,
+            "since": since,
+            "categories": {
+                category.id: category.name
+                for category in event.ticketcategory_set.all()
+            },
+        }
+        yield json.dumps(header)[:-1] + ', "registrations": ['
+
+        rows = []
+        first = True
+        for registration_id, category_id, canceled, entrances in qs.iterator(
+            chunk_size=CHUNK_SIZE
+        ):
+            rows.append(
+                json.dumps(
+                    [
+                        registration_id,
+                        category_id,
+                        int(canceled),
+                        entrances,
+                        *signature_checks(registration_id),
+                    ]
+                )
+            )
+            if len(rows) == CHUNK_SIZE:
+                yield ("" if first else ",") + ",".join(rows)
+                rows = []
+                first = False
+
+        if rows:
+            yield ("" if first else ",") + ",".join(rows)
+        yield "]}"
+
+    return chunks()
@@ -0,0 +1,137 @@
+"""
+Per-worker cache of the scan metadata (events, scan points and last resets).
+
+These rows almost never change during an event, so the scan endpoint reads them
+from memory. Every change bumps a version counter stored in the Django cache so
+that the other workers drop their copy too: the cache backend must be shared
+between them (see CACHES in the settings). SCAN_CACHE_TTL bounds how long
+another worker may serve stale data if it is not.
+"""
+
+import threading
+from time import monotonic
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from ..models import ScanPoint, ScanSeq, TicketEvent
+
+VERSION_KEY = "registrations:scan_metadata_version"
+
+_lock = threading.Lock()
+_state = {"version": None, "loaded_at": 0.0}
+_events = {}
+_points = {}
+_event_points = {}
+
+
+def _clear():
+    _events.clear()
+    _points.clear()
+    _event_points.clear()
+
+
+def _check_freshness():
+    version = cache.get(VERSION_KEY, 0)
+    now = monotonic()
+    if (
+        version != _state["version"]
+        or now - _state["loaded_at"] > settings.SCAN_CACHE_TTL
+    ):
+        with _lock:
+            _clear()
+            _state["version"] = version
+            _state["loaded_at"] = now
+
+
+def _load_event(event_id):
+    with _lock:
+        event = TicketEvent.objects.filter(id=event_id).first()
+        points = (
+            list(
+                ScanPoint.objects.filter(event_id=event_id)
+                .annotate(last_reset=Max("seqs__created"))
+                .order_by("id")
+            )
+            if event is not None
+            else []
+        )
+
+        for point in points:
+            point.event = event
+            _points[point.id] = point
+        _event_points[event_id] = points
+        _events[event_id] = event
+
+    return event, points
+
+
+def get_event(event_id):
+    _check_freshness()
+    if event_id in _events:
+        return _events[event_id]
+    return _load_event(event_id)[0]
+
+
+def get_event_points(event_id):
+    _check_freshness()
+    if event_id in _event_points:
+        return _event_points[event_id]
+    return _load_event(event_id)[1]
+
+
+def get_point(point_id):
+    _check_freshness()
+    if point_id in _points:
+        return _points[point_id]
+
+    event_id = (
+        ScanPoint.objects.filter(id=point_id).values_list("event_id", flat=True).first()
+    )
+    points = _load_event(event_id)[1] if event_id is not None else []
+    point = next((p for p in points if p.id == point_id), None)
+    with _lock:
+        # unknown points are remembered as well
+        _points.setdefault(point_id, point)
+    return point
+
+
+def get_last_reset(point_id):
+    point = get_point(point_id)
+    return point.last_reset if point is not None else None
+
+
+def is_visible(action):
+    """Whether the action happened after the last reset of its scan point"""
+    if action.point_id is None:
+        return True
+    last_reset = get_last_reset(action.point_id)
+    return last_reset is None or last_reset < action.time
+
+
+def invalidate():
+    cache.add(VERSION_KEY, 0, timeout=None)
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # the key was evicted between add and incr
+        cache.set(VERSION_KEY, 1, timeout=None)
+    with _lock:
+        _clear()
+        _state["version"] = None
+
+
+@receiver(post_save, sender=TicketEvent)
+@receiver(post_delete, sender=TicketEvent)
+@receiver(post_save, sender=ScanPoint)
+@receiver(post_delete, sender=ScanPoint)
+@receiver(post_save, sender=ScanSeq)
+@receiver(post_delete, sender=ScanSeq)
+def invalidate_on_change(sender, **kwargs):
+    # a worker reloading before the commit would cache the old rows under the
+    # new version
+    transaction.on_commit(invalidate)
@@ -0,0 +1,64 @@
+"""
+Worker processes for the in-process SVG renderers.
+
+A conversion running in a thread cannot be interrupted, so it runs in a pool of
+worker processes which is killed when a conversion exceeds its timeout, like
+rsvg-convert is. This module is imported by the spawned processes: it must not
+import the models.
+"""
+
+import multiprocessing
+import threading
+
+from django.conf import settings
+
+
+def cairosvg_svg2pdf(svg):
+    import cairosvg
+
+    return cairosvg.svg2pdf(bytestring=svg, dpi=72)
+
+
+class RenderPool:
+    """Run a function in worker processes, killing them on timeout"""
+
+    def __init__(self, func):
+        self.func = func
+        self.lock = threading.Lock()
+        self.pool = None
+        self.slots = None
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                size = settings.TICKET_RENDER_CONCURRENCY
+                # forking a process running threads is unsafe
+                self.pool = multiprocessing.get_context("spawn").Pool(size)
+                self.slots = threading.BoundedSemaphore(size)
+            return self.pool, self.slots
+
+    def run(self, *args, timeout):
+        """
+        Returns the result of the function, or raises multiprocessing.TimeoutError.
+        The conversions running in the other processes of the pool when it is
+        killed fail with a timeout as well.
+        """
+        pool, slots = self._get_pool()
+
+        # the timeout only starts once a process is available
+        with slots:
+            result = pool.apply_async(self.func, args)
+            try:
+                return result.get(timeout)
+            except multiprocessing.TimeoutError:
+                with self.lock:
+                    if self.pool is pool:
+                        self.pool = None
+                pool.terminate()
+                raise
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
@@ -1,20 +1,39 @@
 from typing import Optional
 
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from prometheus_client import Counter
 
-from .codes import get_id_from_code, InvalidCodeException
+from .codes import get_id_from_code, verify_codes, InvalidCodeException
+from .points import is_visible
 from ..models import Registration, ScannerAction, ScanPoint
 
-
 scan_counter = Counter("scanner_code_scan", "Numbers of scans", ["result"])
 state_change_counter = Counter(
     "scanner_code_state_change", "Numbers of scans", ["result"]
 )
 
 
-def get_registration_from_code(code):
+def scan_queryset():
+    """Registrations with everything the scan screen displays, in three queries"""
+    return Registration.objects.select_related("event", "category").prefetch_related(
+        "metas",
+        Prefetch(
+            "events",
+            queryset=ScannerAction.objects.select_related("point"),
+            to_attr="scan_history",
+        ),
+    )
+
+
+def get_registration_from_code(code, queryset=None):
+    if queryset is None:
+        queryset = Registration.objects.all()
+
     registration_id = get_id_from_code(code)  # can raise InvalidCodeException
-    registration = Registration.objects.get(
+    registration = queryset.get(
         pk=registration_id
     )  # can raise Registration.DoesNotExist
     return registration
@@ -22,7 +41,7 @@ def get_registration_from_code(code):
 
 def scan_code(code, operator, event, point: Optional[ScanPoint] = None):
     try:
-        registration = get_registration_from_code(code)
+        registration = get_registration_from_code(code, scan_queryset())
     except InvalidCodeException:
         scan_counter.labels("invalid_code").inc()
         raise
@@ -33,12 +52,17 @@ def scan_code(code, operator, event, point: Optional[ScanPoint] = None):
     if point is not None and point.event_id != registration.event_id:
         raise InvalidCodeException("wrong_event")
 
-    ScannerAction.objects.create(
+    # last resets come from the scan metadata cache
+    registration.scan_history = [a for a in registration.scan_history if is_visible(a)]
+
+    action = ScannerAction.objects.create(
         registration=registration,
         type=ScannerAction.TYPE_SCAN,
         person=operator,
         point=point,
     )
+    # the new scan is always more recent than the last reset
+    registration.scan_history.insert(0, action)
     scan_counter.labels("success").inc()
     return registration
 
@@ -64,3 +88,113 @@ def mark_registration(code, type, operator, point=None):
     )
     state_change_counter.labels(type).inc()
     return registration
+
+
+def _parse_scan_time(value):
+    if value is None:
+        return timezone.now()
+
+    try:
+        time = parse_datetime(value)
+    except (ValueError, TypeError):
+        return None
+
+    if time is not None and timezone.is_naive(time):
+        time = timezone.make_aware(time)
+    return time
+
+
+def scan_codes(scans, operator, point=None):
+    """
+    Record a batch of actions queued by a scanner device while it was offline.
+
+    Each scan is a dict with a `code`, the client `time` in ISO format and an
+    optional `type` (a simple scan by default). Signatures are all checked at
+    once with verify_codes, registrations are then fetched in one query and the
+    actions written with a single bulk insert.
+
+    Returns one result per scan, in the same order.
+    """
+    results = [None] * len(scans)
+    pending = []
+
+    valid_codes, _ = verify_codes(
+        scan["code"] for scan in scans if isinstance(scan.get("code"), str)
+    )
+
+    for i, scan in enumerate(scans):
+        code = scan.get("code")
+        type = scan.get("type", ScannerAction.TYPE_SCAN)
+        counter = (
+            scan_counter if type == ScannerAction.TYPE_SCAN else state_change_counter
+        )
+        results[i] = {"code": code}
+
+        if type not in (choice for choice, _ in ScannerAction.TYPE_CHOICES):
+            results[i]["result"] = "invalid_type"
+            continue
+
+        time = _parse_scan_time(scan.get("time"))
+        if time is None:
+            results[i]["result"] = "invalid_time"
+            continue
+
+        if not isinstance(code, str) or code not in valid_codes:
+            counter.labels("invalid_code").inc()
+            results[i]["result"] = "invalid_code"
+            continue
+
+        pending.append((i, valid_codes[code], type, time, counter))
+
+    registrations = Registration.objects.select_related("category").in_bulk(
+        {registration_id for _, registration_id, *_ in pending}
+    )
+
+    actions = []
+    for i, registration_id, type, time, counter in pending:
+        registration = registrations.get(registration_id)
+
+        if registration is None:
+            counter.labels("missing_code").inc()
+            results[i]["result"] = "missing_code"
+            continue
+
+        results[i].update(
+            {
+                "numero": registration.numero,
+                "full_name": registration.full_name,
+                "category": registration.category.name,
+                "canceled": registration.canceled,
+            }
+        )
+
+        if point is not None and point.event_id != registration.event_id:
+            results[i]["result"] = "wrong_event"
+        elif type != ScannerAction.TYPE_SCAN and registration.canceled:
+            results[i]["result"] = "canceled"
+        else:
+            actions.append(
+                (
+                    ScannerAction(
+                        registration=registration,
+                        type=type,
+                        person=operator,
+                        point=point,
+                    ),
+                    time,
+                )
+            )
+            counter.labels("success" if counter is scan_counter else type).inc()
+            results[i]["result"] = "success"
+
+    if actions:
+        with transaction.atomic():
+            created = ScannerAction.objects.bulk_create(
+                [action for action, _ in actions]
+            )
+            # à cause du auto_add, time est écrasé par la date actuelle
+            for action, (_, time) in zip(created, actions):
+                action.time = time
+            ScannerAction.objects.bulk_update(created, ["time"])
+
+    return results
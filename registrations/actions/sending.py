@@ -0,0 +1,374 @@
+"""
+Pipelined sending of tickets.
+
+Render workers build the emails of each registration (PDF ticket, template,
+attachments) and hand them over through a bounded queue to SMTP workers, each
+holding its own connection. Results come back to the calling thread, which is
+the only one writing ticket statuses.
+
+A send can be run as a SendJob, persisting its progress so that it can be
+resumed after a crash. Registrations are processed in id order and the job
+cursor is the id up to which every registration has been processed; results
+beyond it are known through the job items. Both are written every
+CHECKPOINT_SIZE results or CHECKPOINT_INTERVAL seconds, so that at most that
+many tickets may be sent twice when resuming after a crash. When a run is
+stopped, the tickets not sent yet are dropped and the results of those which
+were being sent are recorded before the final checkpoint.
+"""
+
+import logging
+import queue
+import threading
+from collections import deque
+from smtplib import SMTPRecipientsRefused, SMTPServerDisconnected
+from time import monotonic, sleep
+
+from django import db
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import Count, Q
+
+from .emails import SendContexts, marquer_billets_envoyes, preparer_billet
+from ..models import Registration, SendJob, SendJobItem
+
+logger = logging.getLogger(__name__)
+
+RESULT_SENT = "sent"
+RESULT_REFUSED = "refused"
+RESULT_ERROR = "error"
+
+MAX_RECONNECTIONS = 5
+
+CHECKPOINT_SIZE = 100
+CHECKPOINT_INTERVAL = 10
+
+RESULT_STATES = {
+    RESULT_SENT: SendJobItem.STATE_SENT,
+    RESULT_REFUSED: SendJobItem.STATE_REFUSED,
+    RESULT_ERROR: SendJobItem.STATE_ERROR,
+}
+
+
+class RateLimiter:
+    """Spread calls to wait() so that at most `rate` return each second"""
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+
+        if slot > now:
+            sleep(slot - now)
+
+
+class TicketSender:
+    def __init__(self, concurrency=None, smtp_workers=1, rate=None, queue_size=None):
+        self.concurrency = concurrency or settings.TICKET_RENDER_CONCURRENCY
+        self.smtp_workers = smtp_workers
+        self.rate_limiter = RateLimiter(rate)
+        self.queue_size = queue_size or 2 * (self.concurrency + smtp_workers)
+        # results of the last send that could not be yielded, see send
+        self.unreported = []
+
+    def prepare(self, registration, context):
+        return preparer_billet(registration, context=context)
+
+    def render_worker(self, registrations, mails, results, stop):
+        try:
+            while (item := registrations.get()) is not None:
+                if stop.is_set():
+                    continue
+                registration, context = item
+                try:
+                    messages = self.prepare(registration, context)
+                except Exception as e:
+                    logger.exception("Could not render ticket %s", registration.numero)
+                    results.put((registration, RESULT_ERROR, e))
+                else:
+                    if not stop.is_set():
+                        # blocks while the SMTP workers are behind
+                        mails.put((registration, messages))
+        finally:
+            # render workers are not request threads, nobody else closes this
+            db.connection.close()
+
+    def send_messages(self, messages, connection):
+        """Send the emails of a registration, returns the connection to use next"""
+        for message in messages:
+            self.rate_limiter.wait()
+            for attempt in range(MAX_RECONNECTIONS + 1):
+                message.connection = connection
+                try:
+                    message.send()
+                except SMTPServerDisconnected:
+                    if attempt == MAX_RECONNECTIONS:
+                        raise
+                    connection = get_connection()
+                    connection.open()
+                    continue
+                break
+        return connection
+
+    def smtp_worker(self, mails, results, stop):
+        # an unopened connection would open and close a session per message
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception:
+            # send_messages opens it lazily, failures are reported per ticket
+            logger.exception("Could not connect to the SMTP server")
+        try:
+            while (item := mails.get()) is not None:
+                if stop.is_set():
+                    continue
+                registration, messages = item
+                try:
+                    connection = self.send_messages(messages, connection)
+                except SMTPRecipientsRefused as e:
+                    results.put((registration, RESULT_REFUSED, e))
+                except Exception as e:
+                    logger.exception("Could not send ticket %s", registration.numero)
+                    results.put((registration, RESULT_ERROR, e))
+                else:
+                    results.put((registration, RESULT_SENT, None))
+        finally:
+            connection.close()
+
+    def send(self, registrations):
+        """
+        Send the tickets of the registrations, yielding `(registration, result,
+        exception)` as they are done, result being one of the RESULT_* values.
+
+        If the send is stopped before the end (the generator closed or an
+        exception raised), the tickets not sent yet are dropped. The results of
+        those which were being sent are then left in `unreported`.
+        """
+        todo = queue.Queue(maxsize=self.queue_size)
+        mails = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue()
+        stop = threading.Event()
+        self.unreported = []
+        # the context of each event is built once for the whole send, by this
+        # thread, and shared with the render workers
+        contexts = SendContexts()
+
+        render_threads = [
+            threading.Thread(
+                target=self.render_worker, args=(todo, mails, results, stop)
+            )
+            for _ in range(self.concurrency)
+        ]
+        smtp_threads = [
+            threading.Thread(target=self.smtp_worker, args=(mails, results, stop))
+            for _ in range(self.smtp_workers)
+        ]
+        for thread in render_threads + smtp_threads:
+            thread.start()
+
+        def drain():
+            while not results.empty():
+                yield results.get()
+
+        def wait(threads):
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.1)
+                    yield from drain()
+
+        try:
+            for registration in registrations:
+                # blocks while the render workers are behind
+                todo.put((registration, contexts.get(registration.event)))
+                yield from drain()
+
+            for _ in render_threads:
+                todo.put(None)
+            yield from wait(render_threads)
+            for _ in smtp_threads:
+                mails.put(None)
+            yield from wait(smtp_threads)
+            yield from drain()
+        finally:
+            if any(thread.is_alive() for thread in render_threads + smtp_threads):
+                self.stop_workers(stop, todo, mails, render_threads, smtp_threads)
+            self.unreported = list(drain())
+
+    @staticmethod
+    def stop_workers(stop, todo, mails, render_threads, smtp_threads):
+        """Stop the workers, dropping the tickets they did not start to send"""
+        stop.set()
+        while True:
+            try:
+                todo.get_nowait()
+            except queue.Empty:
+                break
+
+        # the queues are emptied by the workers until they get their sentinel
+        for _ in render_threads:
+            todo.put(None)
+        for thread in render_threads:
+            thread.join()
+        for _ in smtp_threads:
+            mails.put(None)
+        for thread in smtp_threads:
+            thread.join()
+
+
+def filter_registrations(
+    event, start=None, end=None, category_id=None, check_sent_status=True
+):
+    """Registrations of the event whose ticket must be sent"""
+    query = Q(event=event, canceled=False)
+
+    if end is not None:
+        query &= Q(numero__gte=start, numero__lte=end)
+    elif start is not None:
+        query &= Q(numero=start)
+
+    if category_id is not None:
+        query &= Q(category=category_id)
+
+    if check_sent_status:
+        query &= ~Q(ticket_status=Registration.TICKET_SENT)
+
+    return Registration.objects.filter(query)
+
+
+def create_job(event, **filter):
+    """Create a job sending the tickets selected by filter_registrations"""
+    return SendJob.objects.create(
+        event=event,
+        filter=filter,
+        total=filter_registrations(event, **filter).count(),
+    )
+
+
+def remaining_registrations(job):
+    """Registrations of the job still to be sent, failed ones included"""
+    return (
+        filter_registrations(job.event, **job.filter)
+        .filter(
+            Q(pk__gt=job.cursor)
+            | Q(
+                pk__in=job.items.filter(state=SendJobItem.STATE_ERROR).values(
+                    "registration_id"
+                )
+            )
+        )
+        .exclude(
+            pk__in=job.items.filter(
+                state__in=[SendJobItem.STATE_SENT, SendJobItem.STATE_REFUSED]
+            ).values("registration_id")
+        )
+        .order_by("pk")
+    )
+
+
+class JobRunner:
+    """Run or resume a job with a TicketSender, checkpointing its progress"""
+
+    def __init__(self, job, sender):
+        self.job = job
+        self.sender = sender
+        self.dispatched = deque()
+        self.done = set()
+        self.pending = []
+        self.last_checkpoint = monotonic()
+
+    def registrations(self):
+        for registration in (
+            remaining_registrations(self.job)
+            .select_related("event", "category")
+            .prefetch_related("metas")
+            .iterator(chunk_size=500)
+        ):
+            self.dispatched.append(registration.pk)
+            yield registration
+
+    def record(self, registration, result, exception):
+        self.pending.append(
+            SendJobItem(
+                job=self.job,
+                registration=registration,
+                state=RESULT_STATES[result],
+                error=str(exception) if result == RESULT_ERROR else "",
+            )
+        )
+
+        # results come back out of order: the cursor only moves past
+        # registrations whose every predecessor is done
+        self.done.add(registration.pk)
+        while self.dispatched and self.dispatched[0] in self.done:
+            pk = self.dispatched.popleft()
+            self.done.remove(pk)
+            # failed registrations retried on resume are before the cursor
+            self.job.cursor = max(self.job.cursor, pk)
+
+    def checkpoint(self):
+        now = monotonic()
+        sent_ids = [
+            item.registration_id
+            for item in self.pending
+            if item.state == SendJobItem.STATE_SENT
+        ]
+
+        with transaction.atomic():
+            SendJobItem.objects.bulk_create(
+                self.pending,
+                update_conflicts=True,
+                unique_fields=["job", "registration"],
+                update_fields=["state", "error"],
+            )
+            marquer_billets_envoyes(sent_ids)
+
+            counts = dict(
+                self.job.items.order_by()
+                .values_list("state")
+                .annotate(count=Count("id"))
+            )
+            self.job.sent = counts.get(SendJobItem.STATE_SENT, 0)
+            self.job.refused = counts.get(SendJobItem.STATE_REFUSED, 0)
+            self.job.errors = counts.get(SendJobItem.STATE_ERROR, 0)
+            self.job.duration += now - self.last_checkpoint
+            self.job.save()
+
+        self.pending = []
+        self.last_checkpoint = now
+
+    def run(self):
+        """Yields the results like TicketSender.send, saving them on the way"""
+        self.job.status = SendJob.STATUS_RUNNING
+        self.job.save(update_fields=["status", "updated"])
+        self.last_checkpoint = monotonic()
+
+        results = self.sender.send(self.registrations())
+        try:
+            for registration, result, exception in results:
+                self.record(registration, result, exception)
+                if (
+                    len(self.pending) >= CHECKPOINT_SIZE
+                    or monotonic() - self.last_checkpoint > CHECKPOINT_INTERVAL
+                ):
+                    self.checkpoint()
+                yield registration, result, exception
+            self.job.status = SendJob.STATUS_DONE
+        finally:
+            # stops the workers if the run is interrupted, the tickets they were
+            # sending meanwhile are recorded as well
+            results.close()
+            for registration, result, exception in self.sender.unreported:
+                self.record(registration, result, exception)
+
+            if self.job.status != SendJob.STATUS_DONE:
+                self.job.status = SendJob.STATUS_STOPPED
+            self.checkpoint()
@@ -1,31 +1,108 @@
 from datetime import time, timedelta
-from prometheus_client import Counter
+from hashlib import sha256
+from prometheus_client import Counter, Histogram
 from django.template import engines
 import base64
-from io import BytesIO
+import importlib.util
+import json
+import multiprocessing
+import os
+import re
 import subprocess
+import tempfile
 from django.utils.timezone import localtime
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 import pytz
 import uuid
 import io
 
-from icalendar import Alarm, Calendar, Event
+from icalendar import Alarm, Calendar, Event, vText
+from icalendar.parser import foldline
+from PIL import Image
+
+from .codes import gen_signed_message, qrcode_png, qrcode_svg
+from .render_pool import RenderPool, cairosvg_svg2pdf
 
 ticket_generation_counter = Counter(
     "scanner_tickets_generation", "Number of ticket generation", ["result"]
 )
+ticket_stage_duration = Histogram(
+    "scanner_tickets_stage_duration_seconds",
+    "Duration of each ticket generation stage",
+    ["stage"],
+)
+ticket_stage_size = Histogram(
+    "scanner_tickets_stage_size_bytes",
+    "Size of the output of each ticket generation stage",
+    ["stage"],
+    buckets=[2**i * 1024 for i in range(4, 14)],
+)
+ticket_cache_counter = Counter(
+    "scanner_tickets_cache", "Rendered tickets cache lookups", ["result"]
+)
+
+COMPRESSION_NONE = "none"
+COMPRESSION_GS = "gs"
+COMPRESSION_IMAGES = "images"
+
+DATA_URI_RE = re.compile(r"data:image/(png|jpeg|jpg);base64,([A-Za-z0-9+/=\s]+)")
 
 
 class TicketGenerationException(Exception):
     pass
 
 
-def gen_ticket_svg(registration):
-    django_engine = engines["django"]
-    template = django_engine.from_string(
-        registration.event.ticket_template.open().read().decode()
-    )
+# compiled ticket templates by event id, with the name and modification time
+# of the template file they were compiled from
+_compiled_templates = {}
+
+
+def get_template_version(event):
+    """Name and modification time of the ticket template, the latter may be None"""
+    ticket_template = event.ticket_template
+    try:
+        mtime = ticket_template.storage.get_modified_time(ticket_template.name)
+    except (NotImplementedError, OSError):
+        mtime = None
+    return ticket_template.name, mtime
+
+
+def get_ticket_template(event, version=None):
+    ticket_template = event.ticket_template
+    key = version or get_template_version(event)
+    cached = _compiled_templates.get(event.id)
+    if cached is not None and cached[0] == key and key[1] is not None:
+        return cached[1]
+
+    with ticket_template.open() as f:
+        template = engines["django"].from_string(f.read().decode())
+    _compiled_templates[event.id] = (key, template)
+    return template
+
+
+@receiver(post_save, sender="registrations.TicketEvent")
+@receiver(post_delete, sender="registrations.TicketEvent")
+def forget_ticket_template(sender, instance, **kwargs):
+    _compiled_templates.pop(instance.id, None)
+
+
+def gen_ticket_svg(registration, template_version=None, template=None):
+    """
+    Render the SVG ticket template of a registration.
+
+    Besides the registration fields and metas, the QR code is available as
+    `qrcode_path` (path data, one unit per module) and `qrcode_size` (number of
+    modules), e.g. `<svg width="30mm" height="30mm" viewBox="0 0 {{ qrcode_size }}
+    {{ qrcode_size }}"><path d="{{ qrcode_path }}"/></svg>`, or as a base64 PNG
+    in `qrcode_data`, which is only encoded if the template uses it.
+    """
+    if template is None:
+        template = get_ticket_template(registration.event, template_version)
 
     context = {
         "numero": registration.pk,
@@ -34,81 +111,296 @@ def gen_ticket_svg(registration):
         "category": registration.category.name,
         "contact_email": registration.contact_email,
     }
-    context.update({p.property: p.value for p in registration.metas.all()})
-
-    img = registration.qrcode
-    img_data = BytesIO()
-    img.save(img_data, "PNG")
+    context.update(registration.meta_values)
 
-    context["qrcode_data"] = base64.b64encode(img_data.getvalue()).decode("ascii")
+    qrcode = qrcode_svg(registration.pk)
+    context["qrcode_path"] = qrcode.path
+    context["qrcode_size"] = qrcode.size
+    # callables are only evaluated by the template engine when used
+    context["qrcode_data"] = lambda: base64.b64encode(
+        qrcode_png(registration.pk)
+    ).decode("ascii")
 
     return template.render(context)
 
-def gen_ticket(registration):
-    svg = gen_ticket_svg(registration)
 
-    inkscape = subprocess.Popen(
+def _run(command, input, timeout, error_label):
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    try:
+        output, error = process.communicate(input=input, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        ticket_generation_counter.labels("timeout").inc()
+        raise TicketGenerationException("Timeout")
+
+    if process.returncode:
+        ticket_generation_counter.labels(error_label).inc()
+        raise TicketGenerationException(
+            "Return code: %d (%s)"
+            % (process.returncode, error.decode(errors="replace"))
+        )
+
+    return output
+
+
+def _svg_to_pdf_rsvg(svg):
+    return _run(
         [
             "rsvg-convert",
             "--dpi-x=72",
             "--dpi-y=72",
             "--format=pdf",  # format PDF
         ],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+        input=svg,
+        timeout=5,
+        error_label="inkscape_error",
     )
 
+
+_cairosvg_pool = RenderPool(cairosvg_svg2pdf)
+
+
+def _svg_to_pdf_cairosvg(svg):
+    # optional dependency, only needed with this renderer
+    if importlib.util.find_spec("cairosvg") is None:
+        raise ImproperlyConfigured("cairosvg must be installed to render tickets")
+
     try:
-        output, error = inkscape.communicate(input=svg.encode("utf8"), timeout=5)
-    except subprocess.TimeoutExpired:
-        inkscape.kill()
-        inkscape.communicate()
+        return _cairosvg_pool.run(svg, timeout=5)
+    except multiprocessing.TimeoutError:
         ticket_generation_counter.labels("timeout").inc()
         raise TicketGenerationException("Timeout")
-
-    if inkscape.returncode:
+    except Exception as e:
         ticket_generation_counter.labels("inkscape_error").inc()
-        raise TicketGenerationException("Return code: %d" % inkscape.returncode)
+        raise TicketGenerationException(str(e)) from e
+
+
+SVG_RENDERERS = {
+    "rsvg": _svg_to_pdf_rsvg,
+    "cairosvg": _svg_to_pdf_cairosvg,
+}
+
 
+def svg_to_pdf(svg):
+    return SVG_RENDERERS[settings.TICKET_RENDERER](svg)
 
-    gs = subprocess.Popen(
+
+def compress_pdf(pdf):
+    return _run(
         [
             "gs",
             "-sDEVICE=pdfwrite",
             "-dCompatibilityLevel=1.4",
             "-dPDFSETTINGS=/ebook",  # /screen pour + petit, /printer pour meilleure qualité
-            "-dNOPAUSE", "-dQUIET", "-dBATCH",
+            "-dNOPAUSE",
+            "-dQUIET",
+            "-dBATCH",
             "-sOutputFile=-",
-            "-"
+            "-",
         ],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+        input=pdf,
+        timeout=30,
+        error_label="gs_error",
     )
 
-    compressed_output, gs_error = gs.communicate(input=output)
 
-    if gs.returncode:
-        ticket_generation_counter.labels("gs_error").inc()
-        raise TicketGenerationException(f"Ghostscript error: {gs_error.decode()}")
+def downsample_images(svg):
+    """
+    Shrink the images embedded as data URIs in a SVG ticket to at most
+    TICKET_IMAGE_MAX_SIZE pixels, before they reach the PDF converter.
+    """
+    max_size = settings.TICKET_IMAGE_MAX_SIZE
+
+    def downsample(match):
+        try:
+            img = Image.open(io.BytesIO(base64.b64decode(match.group(2))))
+            img.load()
+        except (ValueError, OSError, Image.DecompressionBombError):
+            # invalid, truncated or too big: left as is for the converter
+            return match.group(0)
+
+        if max(img.size) <= max_size:
+            return match.group(0)
+
+        img.thumbnail((max_size, max_size))
+        output = io.BytesIO()
+        if match.group(1) == "png":
+            img.save(output, "PNG", optimize=True)
+        else:
+            img.save(output, "JPEG", quality=85, optimize=True)
+        return "data:image/{};base64,{}".format(
+            match.group(1), base64.b64encode(output.getvalue()).decode("ascii")
+        )
+
+    return DATA_URI_RE.sub(downsample, svg)
+
+
+def _stage(name, func, *args):
+    with ticket_stage_duration.labels(name).time():
+        result = func(*args)
+    ticket_stage_size.labels(name).observe(len(result))
+    return result
+
+
+def convert_ticket(svg):
+    """
+    Convert a rendered SVG ticket to a PDF, compressed according to
+    TICKET_COMPRESSION: not at all, by Ghostscript, or by downsampling the
+    embedded images before the conversion.
+    """
+    compression = settings.TICKET_COMPRESSION
+    if compression not in (COMPRESSION_NONE, COMPRESSION_GS, COMPRESSION_IMAGES):
+        raise ImproperlyConfigured(f"Unknown ticket compression {compression}")
+
+    if compression == COMPRESSION_IMAGES:
+        svg = _stage("downsample", downsample_images, svg)
+
+    ticket = _stage("svg_to_pdf", svg_to_pdf, svg.encode("utf8"))
+
+    if compression == COMPRESSION_GS:
+        ticket = _stage("compress", compress_pdf, ticket)
 
     ticket_generation_counter.labels("success").inc()
-    return compressed_output
+    return ticket
 
-def gen_event_ics(registration):
+
+def ticket_cache_key(registration, template_version=None):
     """
-    Génère un fichier ICS pour l'événement lié à une registration.
-    Retourne le contenu binaire prêt à être envoyé ou sauvegardé.
+    Hash of everything a rendered ticket depends on, or None if the version of
+    the template cannot be known.
+    """
+    name, mtime = template_version or get_template_version(registration.event)
+    if mtime is None:
+        return None
+
+    content = [
+        name,
+        mtime.isoformat(),
+        settings.TICKET_RENDERER,
+        settings.TICKET_COMPRESSION,
+        settings.TICKET_IMAGE_MAX_SIZE,
+        registration.pk,
+        registration.full_name,
+        registration.gender,
+        registration.category.name,
+        registration.contact_email,
+        sorted(registration.meta_values.items()),
+        gen_signed_message(registration.pk).decode(),
+    ]
+    return sha256(json.dumps(content).encode("utf8")).hexdigest()
+
+
+TEMP_SUFFIX = ".tmp"
+
+
+def _cached_ticket_name(registration, key):
+    return f"tickets/{registration.pk}/{key}.pdf"
+
+
+def get_cached_ticket(registration, key):
+    try:
+        with default_storage.open(_cached_ticket_name(registration, key)) as f:
+            ticket = f.read()
+    except FileNotFoundError:
+        ticket_cache_counter.labels("miss").inc()
+        return None
+
+    ticket_cache_counter.labels("hit").inc()
+    return ticket
+
+
+def store_ticket(registration, key, ticket):
+    """
+    Store a rendered ticket, and delete the outdated versions.
+
+    Workers rendering the same ticket at the same time write the same content:
+    on a filesystem storage, each writes a temporary file renamed into place so
+    that readers never see a partial file, and the last one wins.
+    """
+    name = _cached_ticket_name(registration, key)
+    directory, filename = name.rsplit("/", 1)
+
+    try:
+        path = default_storage.path(name)
+    except NotImplementedError:
+        # remote storages write whole objects
+        if not default_storage.exists(name):
+            default_storage.save(name, ContentFile(ticket))
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), suffix=TEMP_SUFFIX, delete=False
+        ) as f:
+            f.write(ticket)
+        if default_storage.file_permissions_mode is not None:
+            os.chmod(f.name, default_storage.file_permissions_mode)
+        os.replace(f.name, path)
+
+    for outdated in default_storage.listdir(directory)[1]:
+        # temporary files of other workers are about to be renamed
+        if outdated != filename and not outdated.endswith(TEMP_SUFFIX):
+            default_storage.delete(f"{directory}/{outdated}")
+
+
+def _lookup_ticket(registration, template_version=None):
+    """Returns the template version, the cache key and the cached ticket if any"""
+    template_version = template_version or get_template_version(registration.event)
+    if not settings.TICKET_CACHE:
+        return template_version, None, None
+
+    key = ticket_cache_key(registration, template_version)
+    if key is None:
+        return template_version, None, None
+
+    return template_version, key, get_cached_ticket(registration, key)
+
+
+def gen_ticket(registration, context=None):
+    """
+    Generate the PDF ticket of a registration. With TICKET_CACHE, rendered
+    tickets are stored by content hash and served again while nothing they
+    depend on has changed.
+
+    `context` is the SendContext of the event, whose ticket template is then
+    used as is.
     """
-    event = registration.event
+    template_version = context.template_version if context else None
+    template = context.ticket_template if context else None
+
+    template_version, key, ticket = _lookup_ticket(registration, template_version)
+    if ticket is not None:
+        return ticket
+
+    ticket = convert_ticket(
+        _stage("template", gen_ticket_svg, registration, template_version, template)
+    )
+
+    if key is not None:
+        store_ticket(registration, key, ticket)
+    return ticket
 
+
+ICS_UID_PLACEHOLDER = "__SCANNER_UID__"
+
+
+def gen_event_ics_skeleton(event):
+    """
+    Génère le fichier ICS d'un événement, avec un UID à remplacer par celui de
+    chaque inscription : voir gen_event_ics.
+    """
     cal = Calendar()
     cal.add('prodid', '-//LaFranceinsoumise//FR')
     cal.add('version', '2.0')
 
     ics_event = Event()
-    ics_event.add('uid', f"{registration.numero}")
+    ics_event.add('uid', ICS_UID_PLACEHOLDER)
     ics_event.add('summary', event.name)
     ics_event.add('dtstart', localtime(event.start_date))
     ics_event.add('dtend', localtime(event.end_date))
@@ -123,4 +415,21 @@ def gen_event_ics(registration):
 
     cal.add_component(ics_event)
 
-    return cal.to_ical()
\ No newline at end of file
+    return cal.to_ical()
+
+
+def gen_event_ics(registration, skeleton=None):
+    """
+    Génère un fichier ICS pour l'événement lié à une registration.
+    Retourne le contenu binaire prêt à être envoyé ou sauvegardé.
+
+    Seul l'UID dépend de l'inscription : passer le résultat de
+    gen_event_ics_skeleton évite de régénérer le reste à chaque fois.
+    """
+    if skeleton is None:
+        skeleton = gen_event_ics_skeleton(registration.event)
+
+    uid = vText(f"{registration.numero}").to_ical().decode()
+    return skeleton.replace(
+        f"UID:{ICS_UID_PLACEHOLDER}".encode(), foldline(f"UID:{uid}").encode()
+    )
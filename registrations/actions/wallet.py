@@ -0,0 +1,202 @@
+"""
+Google Wallet links and Apple Wallet pass signatures.
+
+Keys and certificates are read and parsed once per process, and read again
+only when their files change.
+"""
+
+import hashlib
+import io
+import json
+import os
+import threading
+import zipfile
+from time import time
+
+import jwt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    load_pem_private_key,
+    pkcs12,
+)
+from cryptography.hazmat.primitives.serialization.pkcs7 import (
+    PKCS7Options,
+    PKCS7SignatureBuilder,
+)
+from django.conf import settings
+
+GOOGLE_WALLET_SAVE_URL = "https://pay.google.com/gp/v/save/{}"
+
+# links are JWT in the URL: bigger groups get one link per ticket so that the
+# URL stays short enough for browsers
+MAX_GROUP_SIZE = 10
+
+
+class GoogleWalletSigner:
+    def __init__(self, key_file):
+        with open(key_file) as f:
+            service_account_info = json.load(f)
+
+        self.service_account_email = service_account_info["client_email"]
+        self.private_key = load_pem_private_key(
+            service_account_info["private_key"].encode(), password=None
+        )
+
+    def sign(self, objects):
+        """JWT saving the event ticket objects to Google Wallet"""
+        payload = {
+            "iss": self.service_account_email,
+            "aud": "google",
+            "typ": "savetowallet",
+            "iat": int(time()),
+            "payload": {"eventTicketObjects": objects},
+        }
+        return jwt.encode(payload, self.private_key, algorithm="RS256")
+
+    def save_url(self, objects):
+        return GOOGLE_WALLET_SAVE_URL.format(self.sign(objects))
+
+
+class ApplePassSigner:
+    """
+    Signs pass manifests in process, with the pass certificate and key of the
+    .p12 file, the WWDR intermediate certificate being included in the
+    signature.
+    """
+
+    def __init__(self, p12_path, password, wwdr_path):
+        with open(p12_path, "rb") as f:
+            self.key, self.certificate, _ = pkcs12.load_key_and_certificates(
+                f.read(), password.encode() if password else None
+            )
+
+        with open(wwdr_path, "rb") as f:
+            wwdr = f.read()
+        try:
+            self.wwdr = x509.load_pem_x509_certificate(wwdr)
+        except ValueError:
+            self.wwdr = x509.load_der_x509_certificate(wwdr)
+
+    def sign(self, manifest):
+        """Detached DER signature of manifest.json"""
+        return (
+            PKCS7SignatureBuilder()
+            .set_data(manifest)
+            .add_signer(self.certificate, self.key, hashes.SHA256())
+            .add_certificate(self.wwdr)
+            .sign(Encoding.DER, [PKCS7Options.DetachedSignature, PKCS7Options.Binary])
+        )
+
+
+class _PerFileCache:
+    """Object built from files, built again when one of them changes"""
+
+    def __init__(self, build):
+        self.build = build
+        self.key = None
+        self.value = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _file_key(path):
+        stat = os.stat(path)
+        return path, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def get(self, *paths):
+        key = tuple(self._file_key(path) for path in paths)
+        if self.key != key:
+            with self.lock:
+                if self.key != key:
+                    self.value = self.build()
+                    self.key = key
+        return self.value
+
+
+_google_wallet_signer = _PerFileCache(lambda: GoogleWalletSigner(settings.GCE_KEY_FILE))
+_apple_pass_signer = _PerFileCache(
+    lambda: ApplePassSigner(
+        settings.APPLE_PASS_CERT_PATH,
+        settings.APPLE_CERTIFICATE_PASSWORD,
+        settings.APPLE_WWDR_CERT,
+    )
+)
+
+
+def get_google_wallet_signer():
+    """The signer of the process, reloaded when GCE_KEY_FILE changes"""
+    return _google_wallet_signer.get(settings.GCE_KEY_FILE)
+
+
+def get_apple_pass_signer():
+    """
+    The signer of the process, reloaded when APPLE_PASS_CERT_PATH or
+    APPLE_WWDR_CERT change
+    """
+    return _apple_pass_signer.get(
+        settings.APPLE_PASS_CERT_PATH, settings.APPLE_WWDR_CERT
+    )
+
+
+# images of the passes by event id, with the names of the files they were read
+# from: a new upload always gets a new name
+_pass_images = {}
+
+
+def get_pass_images(event):
+    """Files of the event images in a pass, as {filename: (content, sha1)}"""
+    key = (event.wallet_logo.name, event.wallet_strip.name)
+    cached = _pass_images.get(event.pk)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    images = {}
+    for field, filenames in [
+        (event.wallet_logo, ["logo.png", "icon.png"]),
+        (event.wallet_strip, ["strip.png"]),
+    ]:
+        if field:
+            with field.open("rb") as f:
+                content = f.read()
+            for filename in filenames:
+                images[filename] = (content, hashlib.sha1(content).hexdigest())
+
+    _pass_images[event.pk] = (key, images)
+    return images
+
+
+def pass_hash(pass_data, images, signer=None):
+    """Hash of everything a pass is built from, the signing certificate included"""
+    signer = signer or get_apple_pass_signer()
+    content = [
+        pass_data,
+        sorted((filename, sha1) for filename, (_, sha1) in images.items()),
+        signer.certificate.fingerprint(hashes.SHA256()).hex(),
+    ]
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def build_pkpass(pass_data, images, signer=None):
+    """Build a signed .pkpass archive in memory"""
+    signer = signer or get_apple_pass_signer()
+
+    pass_json = json.dumps(pass_data).encode()
+    files = {
+        "pass.json": pass_json,
+        **{filename: content for filename, (content, _) in images.items()},
+    }
+    manifest = json.dumps(
+        {
+            "pass.json": hashlib.sha1(pass_json).hexdigest(),
+            **{filename: sha1 for filename, (_, sha1) in images.items()},
+        }
+    ).encode()
+    files["manifest.json"] = manifest
+    files["signature"] = signer.sign(manifest)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for filename, content in files.items():
+            archive.writestr(filename, content)
+    return buffer.getvalue()
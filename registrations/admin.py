@@ -6,7 +6,7 @@ from django.urls import reverse
 from django.shortcuts import get_object_or_404
 from django.utils.html import format_html
 
-from .actions.emails import envoyer_billet
+from .actions.emails import SendContexts, envoyer_billet
 from .actions.scans import mark_registration, state_change_counter
 from .models import (
     Registration,
@@ -16,6 +16,7 @@ from .models import (
     TicketCategory,
     ScanPoint,
     TicketAttachment,
+    SendJob,
 )
 from .actions import codes, tickets
 
@@ -224,11 +225,7 @@ class RegistrationAdmin(admin.ModelAdmin):
         return redirect('admin:registrations_registration_change', object_id)
 
     def qrcode_view(self, request, object_id):
-        img = codes.gen_qrcode(object_id)
-        response = HttpResponse(content_type="image/png")
-        img.save(response, "PNG")
-
-        return response
+        return HttpResponse(codes.qrcode_png(object_id), content_type="image/png")
 
     def ticket_view(self, request, object_id):
         registration = get_object_or_404(Registration, pk=object_id)
@@ -273,6 +270,7 @@ class RegistrationAdmin(admin.ModelAdmin):
 
     def send_tickets_action(self, request, queryset):
         connection = get_connection()
+        contexts = SendContexts()
         success = 0
         errors = 0
 
@@ -280,7 +278,11 @@ class RegistrationAdmin(admin.ModelAdmin):
             try:
                 registration.ticket_status = "N"
                 registration.save()
-                envoyer_billet(registration, connection=connection)
+                envoyer_billet(
+                    registration,
+                    connection=connection,
+                    context=contexts.get(registration.event),
+                )
                 success += 1
             except Exception as e:
                 self.message_user(
@@ -332,6 +334,40 @@ class TicketCategoryAdmin(admin.ModelAdmin):
     list_display = ("name", "event", "color", "background_color")
 
 
+class SendJobAdmin(admin.ModelAdmin):
+    model = SendJob
+    list_display = (
+        "id",
+        "event",
+        "status",
+        "total",
+        "sent",
+        "refused",
+        "errors",
+        "throughput",
+        "eta",
+        "updated",
+    )
+    list_filter = ("event", "status")
+    readonly_fields = [field.name for field in SendJob._meta.fields]
+
+    def throughput(self, obj):
+        return f"{obj.throughput:.1f} /s" if obj.throughput else "-"
+
+    throughput.short_description = "Débit"
+
+    def eta(self, obj):
+        if obj.status == SendJob.STATUS_DONE or obj.eta is None:
+            return "-"
+        return f"{obj.eta / 60:.0f} min"
+
+    eta.short_description = "Temps restant"
+
+    def has_add_permission(self, request):
+        return False
+
+
 admin.site.register(Registration, RegistrationAdmin)
 admin.site.register(TicketCategory, TicketCategoryAdmin)
 admin.site.register(TicketEvent, TicketEventAdmin)
+admin.site.register(SendJob, SendJobAdmin)
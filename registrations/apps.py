@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class RegistrationsConfig(AppConfig):
     name = "registrations"
+
+    def ready(self):
+        # connect the cache invalidation signals
+        from .actions import points, tickets  # noqa
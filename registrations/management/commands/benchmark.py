@@ -0,0 +1,162 @@
+import atexit
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from base64 import urlsafe_b64encode
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.oid import NameOID
+from django.core.management.base import BaseCommand
+
+from registrations.actions import codes, wallet
+
+
+def bench_codes(number):
+    messages = []
+    for i in range(number):
+        if i % 4 == 0:
+            # wallet format
+            messages.append(
+                urlsafe_b64encode(codes.gen_pk_signature_qrcode(i).encode())
+                .rstrip(b"=")
+                .decode()
+            )
+        elif i % 10 == 1:
+            messages.append(f"{i}.Y2VjaQ==")
+        else:
+            messages.append(codes.gen_signed_message(i).decode())
+
+    def one_by_one():
+        for message in messages:
+            try:
+                codes.get_id_from_code(message)
+            except codes.InvalidCodeException:
+                pass
+
+    def bulk():
+        codes.verify_codes(messages)
+
+    return [("get_id_from_code", one_by_one), ("verify_codes", bulk)]
+
+
+def self_signed_certificate(name):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+    now = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    return key, certificate
+
+
+class OpenSSLApplePassSigner:
+    """
+    Same as wallet.ApplePassSigner through the openssl command, as passes used
+    to be signed
+    """
+
+    def __init__(self, p12_path, password, wwdr_path):
+        self.p12_path = p12_path
+        self.password = password
+        self.wwdr_path = wwdr_path
+
+    def sign(self, manifest):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            key = os.path.join(temp_dir, "private.key")
+            cert = os.path.join(temp_dir, "cert.pem")
+            manifest_path = os.path.join(temp_dir, "manifest.json")
+            passin = f"pass:{self.password}"
+
+            with open(manifest_path, "wb") as f:
+                f.write(manifest)
+
+            subprocess.run(
+                ["openssl", "pkcs12", "-in", self.p12_path, "-nocerts", "-nodes"]
+                + ["-passin", passin, "-out", key],
+                check=True,
+                capture_output=True,
+            )
+            subprocess.run(
+                ["openssl", "pkcs12", "-in", self.p12_path, "-clcerts", "-nokeys"]
+                + ["-passin", passin, "-out", cert],
+                check=True,
+                capture_output=True,
+            )
+            return subprocess.run(
+                ["openssl", "smime", "-binary", "-sign", "-certfile", self.wwdr_path]
+                + ["-signer", cert, "-inkey", key, "-in", manifest_path]
+                + ["-outform", "DER"],
+                check=True,
+                capture_output=True,
+            ).stdout
+
+
+def bench_pass_signature(number):
+    # throwaway certificates, with the same key size as Apple's
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory)
+    key, certificate = self_signed_certificate("Pass Type ID")
+    p12_path = os.path.join(directory, "pass.p12")
+    with open(p12_path, "wb") as f:
+        f.write(
+            pkcs12.serialize_key_and_certificates(
+                b"pass",
+                key,
+                certificate,
+                None,
+                serialization.BestAvailableEncryption(b"password"),
+            )
+        )
+    wwdr_path = os.path.join(directory, "wwdr.pem")
+    with open(wwdr_path, "wb") as f:
+        f.write(
+            self_signed_certificate("WWDR")[1].public_bytes(serialization.Encoding.PEM)
+        )
+
+    manifest = json.dumps(
+        {name: "0" * 40 for name in ["pass.json", "icon.png", "logo.png"]}
+    ).encode()
+
+    def run(signer_class):
+        signer = signer_class(p12_path, "password", wwdr_path)
+        for _ in range(number):
+            signer.sign(manifest)
+
+    return [
+        ("openssl", lambda: run(OpenSSLApplePassSigner)),
+        ("pkcs7", lambda: run(wallet.ApplePassSigner)),
+    ]
+
+
+BENCHMARKS = {"codes": bench_codes, "pass_signature": bench_pass_signature}
+
+
+class Command(BaseCommand):
+    help = "Mesure le débit des chemins critiques"
+
+    def add_arguments(self, parser):
+        parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+        parser.add_argument("-n", "--number", type=int, default=100000)
+
+    def handle(self, *args, benchmark, number, **options):
+        for name, func in BENCHMARKS[benchmark](number):
+            start = perf_counter()
+            func()
+            duration = perf_counter() - start
+            self.stdout.write(
+                f"{name}: {number / duration:.0f} /s ({duration * 1000:.1f} ms)"
+            )
@@ -1,8 +1,8 @@
 import logging
+import secrets
 import uuid
 import argparse
-from functools import reduce
-from operator import or_
+from collections import defaultdict
 
 import tqdm
 import csv
@@ -12,7 +12,7 @@ from django.core.management.base import BaseCommand, CommandError
 from django.core.exceptions import ValidationError, FieldDoesNotExist
 from django.core.validators import validate_email
 from django.db import transaction
-from django.db.models import Q, CharField
+from django.db.models import CharField
 from django.utils import timezone
 
 from registrations.models import (
@@ -29,6 +29,11 @@ logger.setLevel(logging.DEBUG)
 REQUIRED_FIELDS = {"numero", "category"}
 SPECIAL_FIELDS = {"entry"}
 
+# size of the batches in which rows are read and written
+CHUNK_SIZE = 1000
+
+ENTRY_PERSON = "création admin"
+
 
 def has_attr_changed(obj, attr, value):
     old_value = getattr(obj, attr)
@@ -40,6 +45,33 @@ def has_attr_changed(obj, attr, value):
         return True
 
 
+def parse_entry(value):
+    time = timezone.datetime.fromisoformat(value)
+    if timezone.is_naive(time):
+        time = timezone.make_aware(time)
+    return time
+
+
+def assign_wallet_tokens(registrations):
+    """Like Registration.save(), checking the uniqueness of the tokens by chunks"""
+    missing = [r for r in registrations if not r.wallet_token]
+
+    for start in range(0, len(missing), CHUNK_SIZE):
+        chunk = missing[start : start + CHUNK_SIZE]
+        for _ in range(5):
+            tokens = list({secrets.token_urlsafe(16) for _ in chunk})
+            if (
+                len(tokens) == len(chunk)
+                and not Registration.objects.filter(wallet_token__in=tokens).exists()
+            ):
+                break
+        else:
+            raise ValueError("Could not generate unique tokens after 5 attempts")
+
+        for registration, token in zip(chunk, tokens):
+            registration.wallet_token = token
+
+
 class Command(BaseCommand):
     help = "Import people from a CSV"
 
@@ -135,14 +167,10 @@ class Command(BaseCommand):
             common_fields = common_fields & set(limit_fields)
             self.meta_fields = self.meta_fields & set(limit_fields)
 
+        self.load_existing()
+
         if create_only:
-            lines = list(
-                line
-                for line in lines
-                if not Registration.objects.filter(
-                    event_id=event_id, numero=line["numero"]
-                ).exists()
-            )
+            lines = [line for line in lines if line["numero"] not in self.registrations]
 
         self.db_fields = {}
         for field_name in common_fields:
@@ -160,6 +188,8 @@ class Command(BaseCommand):
                     update_status,
                 )
 
+        self.save_changes()
+
     def validate_line(self, i, line):
         result = True
 
@@ -200,21 +230,95 @@ class Command(BaseCommand):
                 logger.error(f"L{i}: Valeur incorrecte pour {field_name}")
                 result = False
 
+        if line.get("entry"):
+            try:
+                line["entry"] = parse_entry(line["entry"])
+            except ValueError:
+                logger.error(f"L{i}: date d'entrée invalide")
+                result = False
+
         return result
 
+    def load_existing(self):
+        """
+        Load the registrations of the event with their metas and the entries
+        already imported, so that lines are compared in memory.
+        """
+        self.registrations = {}
+        # registrations without numero cannot be matched by any line
+        numeros = {}
+        for registration in Registration.objects.filter(event=self.event).iterator(
+            chunk_size=CHUNK_SIZE
+        ):
+            self.registrations[registration.numero] = registration
+            numeros[registration.id] = registration.numero
+
+        self.metas = defaultdict(dict)
+        for meta in RegistrationMeta.objects.filter(
+            registration__event=self.event
+        ).iterator(chunk_size=CHUNK_SIZE):
+            self.metas[numeros[meta.registration_id]][meta.property] = meta
+
+        self.entries = {
+            (numeros[registration_id], time)
+            for registration_id, time in ScannerAction.objects.filter(
+                registration__event=self.event,
+                type=ScannerAction.TYPE_ENTRANCE,
+                person=ENTRY_PERSON,
+            ).values_list("registration_id", "time")
+        }
+
+        # changes found by modify_if_changed, written by save_changes
+        self.created = []
+        self.updated = {}
+        self.created_metas = []
+        self.updated_metas = {}
+        self.created_entries = []
+
+    def save_changes(self):
+        now = timezone.now()
+        for registration in self.updated.values():
+            # auto_now is not applied by bulk_update
+            registration.modified = now
+        assign_wallet_tokens([*self.created, *self.updated.values()])
+
+        with transaction.atomic():
+            Registration.objects.bulk_create(self.created, batch_size=CHUNK_SIZE)
+            Registration.objects.bulk_update(
+                self.updated.values(),
+                [
+                    "category",
+                    *self.db_fields,
+                    "ticket_status",
+                    "wallet_token",
+                    "modified",
+                ],
+                batch_size=CHUNK_SIZE,
+            )
+            RegistrationMeta.objects.bulk_create(
+                self.created_metas, batch_size=CHUNK_SIZE
+            )
+            RegistrationMeta.objects.bulk_update(
+                self.updated_metas.values(), ["value"], batch_size=CHUNK_SIZE
+            )
+
+            entries = [entry for entry, time in self.created_entries]
+            ScannerAction.objects.bulk_create(entries, batch_size=CHUNK_SIZE)
+            # à cause du auto_add, time est écrasé par la date actuelle
+            for entry, time in self.created_entries:
+                entry.time = time
+            ScannerAction.objects.bulk_update(entries, ["time"], batch_size=CHUNK_SIZE)
+
     def modify_if_changed(
         self,
         properties,
         update_status,
     ):
-        # do not use get_or_create ==> we do not want to create empty registration in case something goes wrong
-        try:
-            registration = Registration.objects.prefetch_related("metas").get(
-                event=self.event, numero=properties["numero"]
-            )
-            metas = {m.property: m for m in registration.metas.all()}
-            changed = False
-        except Registration.DoesNotExist:
+        # nothing is written here: the changes are queued for save_changes
+        registration = self.registrations.get(properties["numero"])
+        metas = self.metas[properties["numero"]]
+
+        if registration is None:
             registration = Registration(
                 event=self.event,
                 **{
@@ -223,14 +327,16 @@ class Command(BaseCommand):
                     if k in self.db_fields or k in REQUIRED_FIELDS
                 },
             )
-            metas = {}
+            self.registrations[registration.numero] = registration
+            self.created.append(registration)
             changed = True
             logger.info(f"{registration.numero}: nouveau billet")
         else:
+            changed = False
             category = properties["category"]
 
             if registration.category_id != category.id:
-                registration.category_id = category.id
+                registration.category = category
                 changed = True
                 logger.info(
                     f"{registration.numero}: categorie => `{registration.category.name}'"
@@ -250,22 +356,9 @@ class Command(BaseCommand):
         new_metas = meta_fields - existing_metas
 
         # updated metas: non empty values that are in both meta_fields and metas
-        if meta_fields & existing_metas:
-            updated_metas_cond = reduce(
-                or_,
-                (
-                    Q(registration=registration, property=f) & ~Q(value=properties[f])
-                    for f in (meta_fields & existing_metas)
-                ),
-            )
-
-            updated_metas = set(
-                RegistrationMeta.objects.filter(updated_metas_cond).values_list(
-                    "property", flat=True
-                )
-            )
-        else:
-            updated_metas = set()
+        updated_metas = {
+            f for f in meta_fields & existing_metas if metas[f].value != properties[f]
+        }
 
         if changed or new_metas or updated_metas:
             if update_status and registration.ticket_status == registration.TICKET_SENT:
@@ -274,38 +367,40 @@ class Command(BaseCommand):
                 )
                 registration.ticket_status = registration.TICKET_MODIFIED
 
-            registration.save()
-
-            with transaction.atomic():
-                if new_metas:
-                    for f in new_metas:
-                        RegistrationMeta.objects.create(
-                            registration_id=registration.id,
-                            property=f,
-                            value=properties[f],
-                        )
-                    logger.info(
-                        f'{registration.numero}: nouveaux champs: {", ".join(new_metas)}'
+            if registration.pk is not None:
+                self.updated[registration.pk] = registration
+
+            if new_metas:
+                for f in new_metas:
+                    metas[f] = RegistrationMeta(
+                        registration=registration,
+                        property=f,
+                        value=properties[f],
                     )
+                    self.created_metas.append(metas[f])
+                logger.info(
+                    f'{registration.numero}: nouveaux champs: {", ".join(new_metas)}'
+                )
 
-                for f in updated_metas:
-                    field_changed = has_attr_changed(metas[f], "value", properties[f])
-                    changed = changed or field_changed
-                    if field_changed:
-                        metas[f].save()
-                        logger.info(
-                            f"{registration.numero}: champ {f} modifié => `{properties[f]}'"
-                        )
+            for f in updated_metas:
+                metas[f].value = properties[f]
+                if metas[f].pk is not None:
+                    self.updated_metas[metas[f].pk] = metas[f]
+                logger.info(
+                    f"{registration.numero}: champ {f} modifié => `{properties[f]}'"
+                )
 
         if entry := properties.get("entry", None):
-            s, created = ScannerAction.objects.get_or_create(
-                registration=registration,
-                type=ScannerAction.TYPE_ENTRANCE,
-                person="création admin",
-                time=timezone.datetime.fromisoformat(entry),
-            )
-            if created:
-                # à cause du auto_add, time est écrasé par la date actuelle
-                ScannerAction.objects.filter(id=s.id).update(
-                    time=timezone.datetime.fromisoformat(entry)
+            if (registration.numero, entry) not in self.entries:
+                self.entries.add((registration.numero, entry))
+                self.created_entries.append(
+                    (
+                        ScannerAction(
+                            registration=registration,
+                            type=ScannerAction.TYPE_ENTRANCE,
+                            person=ENTRY_PERSON,
+                            time=entry,
+                        ),
+                        entry,
+                    )
                 )
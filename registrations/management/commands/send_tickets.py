@@ -1,13 +1,15 @@
-from smtplib import SMTPServerDisconnected, SMTPRecipientsRefused
-
 import tqdm
-from django.core.mail import get_connection
 from django.core.management.base import BaseCommand, CommandError
-from django.db.models import Q
 from django.utils import timezone
 
-from registrations.actions.emails import envoyer_billet
-from registrations.models import Registration, TicketEvent
+from registrations.actions.sending import (
+    JobRunner,
+    TicketSender,
+    create_job,
+    filter_registrations,
+    remaining_registrations,
+)
+from registrations.models import SendJob, SendJobItem, TicketEvent
 
 
 class Command(BaseCommand):
@@ -18,7 +20,7 @@ class Command(BaseCommand):
         self.dry_run = None
 
     def add_arguments(self, parser):
-        parser.add_argument("event_id", type=int)
+        parser.add_argument("event_id", nargs="?", type=int)
         parser.add_argument("registrations_range_start", nargs="?", type=str)
         parser.add_argument("registrations_range_end", nargs="?", type=str)
         parser.add_argument("-c", "--category_id", nargs="?", type=int)
@@ -28,71 +30,134 @@ class Command(BaseCommand):
         parser.add_argument(
             "-d", "--dry-run", action="store_true", dest="dry_run"
         )
+        parser.add_argument(
+            "-j",
+            "--concurrency",
+            type=int,
+            help="Number of tickets rendered in parallel "
+            "(TICKET_RENDER_CONCURRENCY by default)",
+        )
+        parser.add_argument(
+            "-w",
+            "--smtp-workers",
+            type=int,
+            default=1,
+            dest="smtp_workers",
+            help="Number of parallel SMTP connections",
+        )
+        parser.add_argument(
+            "-r", "--rate", type=float, help="Maximum number of emails per second"
+        )
+        parser.add_argument(
+            "--resume",
+            type=int,
+            metavar="JOB_ID",
+            help="Resume an interrupted job instead of creating a new one",
+        )
 
     def handle(
         self,
         *args,
-        event_id,
+        event_id=None,
         registrations_range_start=None,
         registrations_range_end=None,
         check_sent_status,
         category_id=None,
         dry_run,
+        concurrency,
+        smtp_workers,
+        rate=None,
+        resume=None,
         **options
     ):
-        try:
-            ticket_event = TicketEvent.objects.get(id=event_id)
-        except TicketEvent.DoesNotExist:
-            raise CommandError("Event does not exist")
+        if resume is not None:
+            try:
+                job = SendJob.objects.select_related("event").get(id=resume)
+            except SendJob.DoesNotExist:
+                raise CommandError("Job does not exist")
+            # a finished job is resumed to retry its failed tickets
+            if job.status == SendJob.STATUS_DONE and not job.errors:
+                raise CommandError("Job is already done")
+            ticket_event = job.event
+        elif event_id is None:
+            raise CommandError("Either an event or a job to resume is required")
+        else:
+            try:
+                ticket_event = TicketEvent.objects.get(id=event_id)
+            except TicketEvent.DoesNotExist:
+                raise CommandError("Event does not exist")
 
         if timezone.now() > ticket_event.send_tickets_until:
             raise CommandError("Date for ticket sending is past")
 
-        query = Q()
-        if registrations_range_end is not None:
-            query = Q(numero__gte=registrations_range_start) & Q(
-                numero__lte=registrations_range_end
-            )
-        elif registrations_range_start is not None:
-            query = Q(numero=registrations_range_start)
-
-        if category_id is not None:
-            query = query & Q(category=category_id)
-
-        query = query & Q(event=ticket_event) & Q(canceled=False)
-
-        if check_sent_status:
-            query = query & ~Q(ticket_status=Registration.TICKET_SENT)
-
         self.dry_run = dry_run
 
-        connection = get_connection()
-
-        refused = []
-
         if dry_run:
-            self.stdout.write(
-                "Sending {} tickets".format(Registration.objects.filter(query).count())
-            )
+            if resume is None:
+                registrations = filter_registrations(
+                    ticket_event,
+                    start=registrations_range_start,
+                    end=registrations_range_end,
+                    category_id=category_id,
+                    check_sent_status=check_sent_status,
+                )
+            else:
+                registrations = remaining_registrations(job)
+            self.stdout.write("Sending {} tickets".format(registrations.count()))
             return
 
-        for elem in tqdm.tqdm(
-            Registration.objects.filter(query), desc="Sending tickets"
-        ):
-            while True:
-                try:
-                    envoyer_billet(elem, connection=connection)
-                except SMTPServerDisconnected:
-                    connection = get_connection()
-                    continue
-                except SMTPRecipientsRefused:
-                    refused.append(elem)
-                    break
-                break
+        if resume is None:
+            job = create_job(
+                ticket_event,
+                start=registrations_range_start,
+                end=registrations_range_end,
+                category_id=category_id,
+                check_sent_status=check_sent_status,
+            )
+            self.stdout.write(
+                "Job {} created, resume it with --resume {}".format(job.id, job.id)
+            )
 
-        connection.close()
+        sender = TicketSender(
+            concurrency=concurrency, smtp_workers=smtp_workers, rate=rate
+        )
 
-        for elem in refused:
-            self.stdout.write(
-                "Could not send to {} ({})".format(elem.contact_email, elem.numero)
+        results = JobRunner(job, sender).run()
+        try:
+            for _ in tqdm.tqdm(
+                results,
+                # failed items are retried
+                initial=job.sent + job.refused,
+                total=job.total,
+                desc="Sending tickets",
+            ):
+                pass
+        except KeyboardInterrupt:
+            # stops the workers and saves the progress right away
+            results.close()
+            raise CommandError("Interrupted, resume with --resume {}".format(job.id))
+
+        for item in job.items.filter(
+            state__in=[SendJobItem.STATE_REFUSED, SendJobItem.STATE_ERROR]
+        ).select_related("registration"):
+            if item.state == SendJobItem.STATE_REFUSED:
+                self.stdout.write(
+                    "Could not send to {} ({})".format(
+                        item.registration.contact_email, item.registration.numero
+                    )
+                )
+            else:
+                self.stdout.write(
+                    "Error for {}: {}".format(item.registration.numero, item.error)
+                )
+
+        self.stdout.write(
+            "Job {}: {} sent, {} refused, {} errors in {:.0f}s ({:.1f} tickets/s)".format(
+                job.id,
+                job.sent,
+                job.refused,
+                job.errors,
+                job.duration,
+                job.throughput or 0,
             )
+        )
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("registrations", "0021_ticketevent_wallet_strip"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="registration",
+            name="modified",
+            field=models.DateTimeField(
+                auto_now=True, db_index=True, verbose_name="Last modification"
+            ),
+        ),
+    ]
@@ -0,0 +1,143 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("registrations", "0022_registration_modified"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SendJob",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "filter",
+                    models.JSONField(default=dict, verbose_name="Registrations filter"),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("R", "Running"), ("S", "Stopped"), ("D", "Done")],
+                        default="R",
+                        max_length=1,
+                        verbose_name="Status",
+                    ),
+                ),
+                (
+                    "cursor",
+                    models.PositiveIntegerField(
+                        default=0,
+                        verbose_name="Last registration id before which everything was processed",
+                    ),
+                ),
+                (
+                    "total",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="Number of registrations"
+                    ),
+                ),
+                (
+                    "sent",
+                    models.PositiveIntegerField(default=0, verbose_name="Tickets sent"),
+                ),
+                (
+                    "refused",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="Recipients refused"
+                    ),
+                ),
+                (
+                    "errors",
+                    models.PositiveIntegerField(default=0, verbose_name="Errors"),
+                ),
+                (
+                    "duration",
+                    models.FloatField(
+                        default=0, verbose_name="Sending duration (seconds)"
+                    ),
+                ),
+                (
+                    "created",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Creation date"
+                    ),
+                ),
+                (
+                    "updated",
+                    models.DateTimeField(auto_now=True, verbose_name="Last checkpoint"),
+                ),
+                (
+                    "event",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="send_jobs",
+                        to="registrations.ticketevent",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Sending job",
+                "verbose_name_plural": "Sending jobs",
+                "ordering": ("-created",),
+            },
+        ),
+        migrations.CreateModel(
+            name="SendJobItem",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "state",
+                    models.CharField(
+                        choices=[
+                            ("S", "Sent"),
+                            ("R", "Recipient refused"),
+                            ("E", "Error"),
+                        ],
+                        max_length=1,
+                        verbose_name="State",
+                    ),
+                ),
+                ("error", models.TextField(blank=True, verbose_name="Error")),
+                (
+                    "job",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="items",
+                        to="registrations.sendjob",
+                    ),
+                ),
+                (
+                    "registration",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="send_job_items",
+                        to="registrations.registration",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("job", "registration")},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("registrations", "0023_sendjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="registration",
+            name="wallet_pass_hash",
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+    ]
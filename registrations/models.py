@@ -1,32 +1,15 @@
 from datetime import timezone
-import hashlib
-import io
 import secrets
-import subprocess
 import logging
-from time import strftime, time
+from time import strftime
 import uuid
 
 from django.urls import reverse
 from django.db import transaction
 from django.core.files.base import ContentFile
-from google.oauth2.service_account import Credentials
-from google.auth import crypt
-import jwt
-import json
-import os
-import tempfile
-import zipfile
-from OpenSSL import crypto
-from cryptography import x509
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.serialization import pkcs12
-from cryptography.hazmat.primitives.serialization.pkcs7 import PKCS7SignatureBuilder
-from cryptography.hazmat.primitives.serialization import Encoding
-from cryptography.hazmat.backends import default_backend
-import shutil
 
 from django.db import models
+from django.utils.functional import cached_property
 from django.utils.text import slugify
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
@@ -34,6 +17,12 @@ from django.core.files.storage import default_storage
 import pytz
 
 from .actions.codes import gen_pk_signature_qrcode, gen_qrcode, gen_signed_message
+from .actions.wallet import (
+    build_pkpass,
+    get_google_wallet_signer,
+    get_pass_images,
+    pass_hash,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -180,6 +169,9 @@ class Registration(models.Model):
     )
 
     canceled = models.BooleanField(_("Canceled"), default=False)
+    modified = models.DateTimeField(
+        _("Last modification"), auto_now=True, db_index=True
+    )
     
     wallet_token = models.CharField(max_length=32, unique=False, blank=False, null=False)
     
@@ -219,7 +211,19 @@ class Registration(models.Model):
     
     @property
     def google_wallet_url(self):
-        object_payload = {
+        return self.get_google_wallet_url()
+
+    def get_google_wallet_url(self, signer=None):
+        """
+        Link adding the ticket to Google Wallet, signed by the signer of the
+        process if none is given.
+        """
+        signer = signer or get_google_wallet_signer()
+        return signer.save_url([self.google_wallet_object()])
+
+    def google_wallet_object(self):
+        """Event ticket object of the registration, in Google Wallet format"""
+        return {
             "id": f"{settings.GOOGLE_WALLET_USER_ID}.{self.numero}",
             "classId": f"{settings.GOOGLE_WALLET_USER_ID}.{self.event.google_wallet_class_id}",
             "ticketHolderName": self.full_name,
@@ -243,31 +247,6 @@ class Registration(models.Model):
                 "value": gen_pk_signature_qrcode(self.pk),  # Use the QR code text representation
             },
         }
-
-        credentials = Credentials.from_service_account_file(
-            settings.GCE_KEY_FILE,
-            scopes=["https://www.googleapis.com/auth/wallet_object.issuer"]
-        )
-        
-        with open(settings.GCE_KEY_FILE) as f:
-            service_account_info = json.load(f)
-
-        private_key = service_account_info["private_key"]
-
-        # Structure du JWT
-        payload = {
-            "iss": credentials.service_account_email,
-            "aud": "google",
-            "typ": "savetowallet",
-            "iat": int(time()),
-            "payload": {
-                "eventTicketObjects": [object_payload]
-            }
-        }
-
-        token = jwt.encode(payload, private_key, algorithm="RS256")
-
-        return f"https://pay.google.com/gp/v/save/{token}"
     
     wallet_pass = models.FileField(
         upload_to='wallet_passes/',
@@ -276,44 +255,61 @@ class Registration(models.Model):
         verbose_name="Apple Wallet Pass",
         help_text="Fichier .pkpass généré automatiquement"
     )
+    # hash des données du pass enregistré, voir generate_wallet_pass
+    wallet_pass_hash = models.CharField(max_length=32, blank=True, editable=False)
     
     @property
     def apple_wallet_url(self):
-        self.generate_wallet_pass()
+        # le pass est généré au premier téléchargement
         return reverse('download_pass', kwargs={
             'registration_id': self.pk,
             'token': self.wallet_token
         })
 
+    @property
+    def wallet_pass_serial(self):
+        """Numéro de série du pass, stable pour une inscription"""
+        return str(
+            uuid.uuid5(uuid.NAMESPACE_URL, f"{settings.APPLE_PASS_TYPE_ID}/{self.pk}")
+        )
+
     def generate_wallet_pass(self):
+        """
+        Génère le pass s'il n'existe pas ou si ses données ont changé : le hash
+        des données, des images et du certificat est enregistré avec le pass
+        (le stockage peut renommer le fichier). Renvoie True si le pass a été
+        (re)généré.
+        """
         try:
+            pass_data = self._get_pass_data()
+            images = get_pass_images(self.event)
+            current_hash = pass_hash(pass_data, images)
+            filename = f"ticket_{self.numero}_{current_hash}.pkpass"
+
+            if (
+                self.wallet_pass
+                and self.wallet_pass_hash == current_hash
+                and self.wallet_pass.storage.exists(self.wallet_pass.name)
+            ):
+                return False
+
             # 1. Supprimer l'ancien fichier s'il existe
             if self.wallet_pass:
                 try:
                     self.wallet_pass.delete(save=False)
-                except:
-                    pass
-            
+                except OSError as e:
+                    # FileNotFoundError compris : le nouveau pass le remplace
+                    logger.warning(f"Impossible de supprimer l'ancien pass : {e}")
+
             # 2. Générer le contenu
-            pkpass_data = self._create_pkpass_file(self._get_pass_data())
-            if not pkpass_data:
-                raise ValueError("Erreur de génération du fichier .pkpass")
-            
-            # 3. Chemin relatif de destination
-            filename = f"ticket_{self.numero}.pkpass"
-            full_path = os.path.join(settings.MEDIA_ROOT, 'wallet_passes', filename)
-            
-            # 5. Écrire physiquement le fichier
-            with open(full_path, 'wb') as f:
-                f.write(pkpass_data)
-            
-            # 6. Lier au modèle
-            self.wallet_pass.save(filename, ContentFile(pkpass_data), save=True)
-            
-            # Double vérification
-            if not os.path.exists(full_path):
-                raise RuntimeError("Le fichier n'a pas été créé physiquement")
-                
+            pkpass_data = build_pkpass(pass_data, images)
+
+            # 3. Enregistrer le fichier, une seule écriture
+            self.wallet_pass.save(filename, ContentFile(pkpass_data), save=False)
+            self.wallet_pass_hash = current_hash
+            self.save(update_fields=["wallet_pass", "wallet_pass_hash"])
+            return True
+
         except Exception as e:
             logger.error(f"Erreur critique lors de la génération du pass: {str(e)}")
             raise
@@ -324,7 +320,7 @@ class Registration(models.Model):
             "formatVersion": 1,
             "teamIdentifier": settings.APPLE_TEAM_ID,
             "passTypeIdentifier": settings.APPLE_PASS_TYPE_ID,
-            "serialNumber": str(uuid.uuid4()),
+            "serialNumber": self.wallet_pass_serial,
             "organizationName": "La France insoumise",
             "relevantDate": self.event.start_date.astimezone(pytz.timezone('Europe/Paris')).isoformat(),
             "expirationDate": self.event.end_date.astimezone(pytz.timezone('Europe/Paris')).isoformat(),
@@ -356,152 +352,71 @@ class Registration(models.Model):
             "logoText": self.event.name,
         }
         
-        if self.metas.filter(property="price").exists():
-            pass_data["eventTicket"]["auxiliaryFields"] = [{
+        metas = self.meta_values
+        auxiliary_fields = []
+
+        if "price" in metas:
+            auxiliary_fields.append({
                 "key": "price",
                 "label": "Prix",
-                "value": self.metas.get(property="price").value
-            }]
-            
-        if self.metas.filter(property="status").exists():
-            if self.metas.get(property="status").value == "on-hold":
-                pass_data["eventTicket"]["auxiliaryFields"].append({
-                    "key": "status",
-                    "label": "Statut du paiement",
-                    "value": "En attente de paiement"
-                })
-            elif self.metas.get(property="status").value == "completed":
-                pass_data["eventTicket"]["auxiliaryFields"].append({
-                    "key": "status",
-                    "label": "Statut du paiement",
-                    "value": "Paiement terminé"
-                })
-            
-        if self.metas.filter(property="enfants").exists():
-            pass_data["eventTicket"]["auxiliaryFields"].append({
+                "value": metas["price"]
+            })
+
+        if metas.get("status") == "on-hold":
+            auxiliary_fields.append({
+                "key": "status",
+                "label": "Statut du paiement",
+                "value": "En attente de paiement"
+            })
+        elif metas.get("status") == "completed":
+            auxiliary_fields.append({
+                "key": "status",
+                "label": "Statut du paiement",
+                "value": "Paiement terminé"
+            })
+
+        if "enfants" in metas:
+            auxiliary_fields.append({
                 "key": "enfants",
                 "label": "Nombre d'enfants",
-                "value": self.metas.get(property="enfants").value
+                "value": metas["enfants"]
             })
-            
-        if self.metas.filter(property="is_minor").exists() and self.metas.get(property="is_minor").value.lower() == "true":
-            pass_data["eventTicket"]["auxiliaryFields"].append({
+
+        if metas.get("is_minor", "").lower() == "true":
+            auxiliary_fields.append({
                 "key": "is_minor",
                 "label": "Mineur",
                 "value": "Oui"
             })
-    
-        return pass_data
-
-    def _create_pkpass_file(self, pass_data):
-        """Crée le fichier .pkpass en mémoire"""
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # 1. Crée pass.json
-            with open(os.path.join(temp_dir, "pass.json"), 'w') as f:
-                json.dump(pass_data, f)
 
-            # 2. Copie les images
-            self._copy_pass_images(temp_dir)
+        if auxiliary_fields:
+            pass_data["eventTicket"]["auxiliaryFields"] = auxiliary_fields
 
-            # 3. Crée manifest.json
-            self._create_manifest(temp_dir)
-
-            # 4. Signe le manifest
-            self._sign_manifest(temp_dir)
-
-            # 5. Crée l'archive ZIP
-            return self._create_zip_archive(temp_dir)
-
-    def _copy_pass_images(self, temp_dir):
-        """Copie les images nécessaires pour le pass"""
-        if self.event.wallet_logo:
-            shutil.copy(self.event.wallet_logo.path, os.path.join(temp_dir, "logo.png"))
-            shutil.copy(self.event.wallet_logo.path, os.path.join(temp_dir, "icon.png"))
-        
-        if self.event.wallet_strip:
-            shutil.copy(self.event.wallet_strip.path, os.path.join(temp_dir, "strip.png"))
-
-    def _create_manifest(self, temp_dir):
-        """Génère le fichier manifest.json"""
-        manifest = {}
-        for filename in os.listdir(temp_dir):
-            if filename != "manifest.json":
-                with open(os.path.join(temp_dir, filename), 'rb') as f:
-                    manifest[filename] = hashlib.sha1(f.read()).hexdigest()
-        
-        with open(os.path.join(temp_dir, "manifest.json"), 'w') as f:
-            json.dump(manifest, f)
-
-    def _sign_manifest(self, temp_dir):
-        try:
-            cert_path = settings.APPLE_PASS_CERT_PATH
-            password = settings.APPLE_CERTIFICATE_PASSWORD
-            
-            if not os.path.exists(cert_path):
-                raise FileNotFoundError(f"Certificat introuvable : {cert_path}")
-            
-            # 1. Extraire la clé privée
-            subprocess.run([
-                "openssl", "pkcs12",
-                "-in", cert_path,
-                "-nocerts", "-nodes",
-                "-passin", f"pass:{password}",
-                "-out", os.path.join(temp_dir, "private.key")
-            ], check=True)
-
-            # 2. Extraire le certificat
-            subprocess.run([
-                "openssl", "pkcs12",
-                "-in", cert_path,
-                "-clcerts", "-nokeys",
-                "-passin", f"pass:{password}",
-                "-out", os.path.join(temp_dir, "cert.pem")
-            ], check=True)
-
-            # 3. Signer le fichier manifest.json
-            result = subprocess.run([
-                "openssl", "smime", "-binary", "-sign",
-                "-certfile", os.path.join(temp_dir, "cert.pem"),
-                "-signer", os.path.join(temp_dir, "cert.pem"),
-                "-inkey", os.path.join(temp_dir, "private.key"),
-                "-in", os.path.join(temp_dir, "manifest.json"),
-                "-out", os.path.join(temp_dir, "signature"),
-                "-outform", "DER"
-            ], check=True)
-            
-            # delete private key and cert files
-            os.remove(os.path.join(temp_dir, "private.key"))
-            os.remove(os.path.join(temp_dir, "cert.pem"))
-            
-            if result.returncode != 0:
-                raise ValueError(f"Erreur OpenSSL : {result.stderr}")
-                
-        except subprocess.CalledProcessError as e:
-            error_msg = f"""
-            Erreur lors de la signature :
-            Sortie: {e.stdout}
-            Erreur: {e.stderr}
-            """
-            logger.error(error_msg)
-            raise ValueError("Échec de la signature OpenSSL") from e
-
-    def _create_zip_archive(self, temp_dir):
-        """Crée l'archive ZIP en mémoire"""
-        buffer = io.BytesIO()
-        with zipfile.ZipFile(buffer, 'w') as zipf:
-            for filename in os.listdir(temp_dir):
-                zipf.write(
-                    os.path.join(temp_dir, filename),
-                    arcname=filename
-                )
-        return buffer.getvalue()
+        return pass_data
 
     def __str__(self):
         return "{} - {} ({})".format(self.numero, self.full_name, self.category.name)
     
+    @cached_property
+    def meta_values(self):
+        """
+        Metas as a {property: value} dict, read once per instance (without any
+        query when the metas were prefetched) and forgotten on save.
+        """
+        return {meta.property: meta.value for meta in self.metas.all()}
+
+    def forget_meta_values(self):
+        self.__dict__.pop("meta_values", None)
+        getattr(self, "_prefetched_objects_cache", {}).pop("metas", None)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.forget_meta_values()
+        super().refresh_from_db(*args, **kwargs)
+
     def save(self, *args, **kwargs):
         if not self.wallet_token:
             self.wallet_token = self.generate_unique_token()
+        self.forget_meta_values()
         super().save(*args, **kwargs)
 
     class Meta:
@@ -517,6 +432,20 @@ class RegistrationMeta(models.Model):
         "Registration", related_name="metas", on_delete=models.CASCADE
     )
 
+    def _forget_registration_meta_values(self):
+        # only the registration instance this meta is attached to can be told
+        if self._meta.get_field("registration").is_cached(self):
+            self.registration.forget_meta_values()
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._forget_registration_meta_values()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self._forget_registration_meta_values()
+        return result
+
     class Meta:
         unique_together = ("registration", "property")
 
@@ -543,3 +472,77 @@ class ScannerAction(models.Model):
 
     class Meta:
         ordering = ["-pk"]
+
+
+class SendJob(models.Model):
+    STATUS_RUNNING = "R"
+    STATUS_STOPPED = "S"
+    STATUS_DONE = "D"
+    STATUS_CHOICES = (
+        (STATUS_RUNNING, _("Running")),
+        (STATUS_STOPPED, _("Stopped")),
+        (STATUS_DONE, _("Done")),
+    )
+
+    event = models.ForeignKey(
+        TicketEvent, related_name="send_jobs", on_delete=models.CASCADE
+    )
+    filter = models.JSONField(_("Registrations filter"), default=dict)
+    status = models.CharField(
+        _("Status"), max_length=1, choices=STATUS_CHOICES, default=STATUS_RUNNING
+    )
+    cursor = models.PositiveIntegerField(
+        _("Last registration id before which everything was processed"), default=0
+    )
+    total = models.PositiveIntegerField(_("Number of registrations"), default=0)
+    sent = models.PositiveIntegerField(_("Tickets sent"), default=0)
+    refused = models.PositiveIntegerField(_("Recipients refused"), default=0)
+    errors = models.PositiveIntegerField(_("Errors"), default=0)
+    duration = models.FloatField(_("Sending duration (seconds)"), default=0)
+    created = models.DateTimeField(_("Creation date"), auto_now_add=True)
+    updated = models.DateTimeField(_("Last checkpoint"), auto_now=True)
+
+    @property
+    def processed(self):
+        return self.sent + self.refused + self.errors
+
+    @property
+    def throughput(self):
+        """Tickets processed per second"""
+        return self.processed / self.duration if self.duration else None
+
+    @property
+    def eta(self):
+        """Estimated remaining time in seconds"""
+        if not self.throughput:
+            return None
+        return max(self.total - self.processed, 0) / self.throughput
+
+    def __str__(self):
+        return f"{self.event.name} #{self.pk}"
+
+    class Meta:
+        verbose_name = _("Sending job")
+        verbose_name_plural = _("Sending jobs")
+        ordering = ("-created",)
+
+
+class SendJobItem(models.Model):
+    STATE_SENT = "S"
+    STATE_REFUSED = "R"
+    STATE_ERROR = "E"
+    STATE_CHOICES = (
+        (STATE_SENT, _("Sent")),
+        (STATE_REFUSED, _("Recipient refused")),
+        (STATE_ERROR, _("Error")),
+    )
+
+    job = models.ForeignKey(SendJob, related_name="items", on_delete=models.CASCADE)
+    registration = models.ForeignKey(
+        Registration, related_name="send_job_items", on_delete=models.CASCADE
+    )
+    state = models.CharField(_("State"), max_length=1, choices=STATE_CHOICES)
+    error = models.TextField(_("Error"), blank=True)
+
+    class Meta:
+        unique_together = ("job", "registration")
@@ -40,16 +40,13 @@ class EventSerializer(serializers.ModelSerializer):
 class RegistrationMetasField(serializers.DictField):
     child = serializers.CharField(max_length=255)
 
-    def to_representation(self, metas):
-        return {meta.property: meta.value for meta in metas.all()}
-
 
 class RegistrationSerializer(serializers.ModelSerializer):
-    metas = RegistrationMetasField()
+    metas = RegistrationMetasField(source="meta_values")
     contact_email = serializers.EmailField()
 
     def create(self, validated_data):
-        metas = validated_data.pop("metas", {})
+        metas = validated_data.pop("meta_values", {})
         registration = Registration.objects.create(**validated_data)
         for property, value in metas.items():
             RegistrationMeta.objects.create(
@@ -59,7 +56,7 @@ class RegistrationSerializer(serializers.ModelSerializer):
         return registration
 
     def update(self, registration, validated_data):
-        metas = validated_data.pop("metas", {})
+        metas = validated_data.pop("meta_values", {})
         result = super().update(registration, validated_data)
 
         for property, value in metas.items():
@@ -70,6 +67,7 @@ class RegistrationSerializer(serializers.ModelSerializer):
                 meta.value = value
                 meta.save()
 
+        registration.forget_meta_values()
         return result
 
     class Meta:
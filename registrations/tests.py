@@ -1,16 +1,65 @@
+import base64
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+from smtplib import SMTPRecipientsRefused
+from unittest import mock, skipUnless
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import timedelta
+from hashlib import sha256
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.serialization import pkcs7, pkcs12
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.conf import settings
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
+from icalendar import Calendar
+import jwt
+from PIL import Image
+from prometheus_client import REGISTRY
+import requests
 
 from registrations.models import (
     Registration,
     RegistrationMeta,
     ScannerAction,
+    ScanPoint,
+    ScanSeq,
+    SendJob,
     TicketEvent,
     TicketCategory,
+    TicketAttachment,
 )
 
-from .actions import codes
+from .actions import (
+    codes,
+    email_templates,
+    emails,
+    http,
+    points,
+    render_pool,
+    sending,
+    tickets,
+    wallet,
+)
+from .management.commands.benchmark import (
+    OpenSSLApplePassSigner,
+    self_signed_certificate,
+)
 
 
 class RegistrationTestCase(TestCase):
@@ -58,6 +107,124 @@ class RegistrationTestCase(TestCase):
         registration.contact_emails = ["user@example.com", "copy@example.com"]
         self.assertEqual(registration.contact_email, "user@example.com")
 
+    def test_meta_values(self):
+        self.event.start_date = self.event.end_date = timezone.now()
+        self.event.save()
+        registration = Registration.objects.create(
+            numero=1, full_name="Full Name", event=self.event, category=self.category
+        )
+        RegistrationMeta.objects.create(
+            property="status", value="completed", registration=registration
+        )
+        RegistrationMeta.objects.create(
+            property="is_minor", value="True", registration=registration
+        )
+
+        registration = Registration.objects.select_related(
+            "event", "category"
+        ).prefetch_related("metas")[0]
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                registration.meta_values, {"status": "completed", "is_minor": "True"}
+            )
+            pass_data = registration._get_pass_data()
+        self.assertEqual(
+            [field["key"] for field in pass_data["eventTicket"]["auxiliaryFields"]],
+            ["status", "is_minor"],
+        )
+
+        RegistrationMeta.objects.filter(property="is_minor").delete()
+        registration.save()
+        self.assertEqual(registration.meta_values, {"status": "completed"})
+
+
+class ImportPersonsTestCase(TestCase):
+    def setUp(self):
+        self.event = TicketEvent.objects.create(
+            name="Événement", send_tickets_until=timezone.now()
+        )
+        self.category = TicketCategory.objects.create(
+            name="Catégorie",
+            import_key="cat",
+            color="white",
+            background_color="blue",
+            event=self.event,
+        )
+        self.sent = Registration.objects.create(
+            event=self.event,
+            numero="1",
+            category=self.category,
+            full_name="Alice",
+            ticket_status=Registration.TICKET_SENT,
+        )
+        RegistrationMeta.objects.create(
+            registration=self.sent, property="price", value="10"
+        )
+        self.unchanged = Registration.objects.create(
+            event=self.event,
+            numero="2",
+            category=self.category,
+            full_name="Bob",
+            ticket_status=Registration.TICKET_SENT,
+        )
+        RegistrationMeta.objects.create(
+            registration=self.unchanged, property="price", value="20"
+        )
+
+    def import_persons(self, content, **options):
+        call_command(
+            "import_persons",
+            self.event.id,
+            input=io.StringIO(content),
+            verbosity=0,
+            **options,
+        )
+
+    def test_import(self):
+        content = (
+            "numero,category,full_name,price,entry\n"
+            "1,cat,Alice,15,\n"
+            "2,cat,Bob,20,\n"
+            "3,cat,Carole,30,2024-05-01T10:00:00\n"
+            "3,cat,Carole,30,2024-05-01T10:00:00\n"
+            "4,nawak,David,40,\n"
+        )
+        self.import_persons(content)
+
+        self.sent.refresh_from_db()
+        self.assertEqual(self.sent.ticket_status, Registration.TICKET_MODIFIED)
+        self.assertEqual(self.sent.meta_values, {"price": "15"})
+        self.unchanged.refresh_from_db()
+        self.assertEqual(self.unchanged.ticket_status, Registration.TICKET_SENT)
+
+        created = Registration.objects.get(event=self.event, numero="3")
+        self.assertEqual(created.full_name, "Carole")
+        self.assertEqual(created.meta_values, {"price": "30"})
+        self.assertTrue(created.wallet_token)
+        entry = created.events.get()
+        self.assertEqual(
+            entry.time,
+            timezone.make_aware(timezone.datetime(2024, 5, 1, 10)),
+        )
+        self.assertFalse(Registration.objects.filter(numero="4").exists())
+
+        # importing the same file again changes nothing
+        modified = created.modified
+        self.import_persons(content)
+        created.refresh_from_db()
+        self.assertEqual(created.modified, modified)
+        self.assertEqual(created.events.count(), 1)
+
+    def test_create_only(self):
+        self.import_persons(
+            "numero,category,full_name\n1,cat,Alicia\n3,cat,Carole\n",
+            create_only=True,
+        )
+
+        self.sent.refresh_from_db()
+        self.assertEqual(self.sent.full_name, "Alice")
+        self.assertTrue(Registration.objects.filter(numero="3").exists())
+
 
 class ValidationTestCase(TestCase):
     def setUp(self):
@@ -89,8 +256,12 @@ class ViewTestCase(TestCase):
         RegistrationMeta.objects.create(
             property="bus", value="Lille", registration=self.registration
         )
+        self.point = ScanPoint.objects.create(event=self.event, name="Entrée")
         ScannerAction.objects.create(registration=self.registration, type="scan")
 
+        # the test transaction is never committed
+        points.invalidate()
+
     def test_author_is_required(self):
         response = self.client.get(
             reverse("view_code", kwargs={"code": "1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk="})
@@ -112,6 +283,7 @@ class ViewTestCase(TestCase):
             json,
             {
                 "numero": "1",
+                "ticket_event_id": self.event.id,
                 "canceled": False,
                 "gender": "",
                 "full_name": "Full Name",
@@ -126,10 +298,182 @@ class ViewTestCase(TestCase):
 
         self.assertEqual(self.registration.events.count(), 2)
 
+    def test_get_info_hides_actions_before_reset(self):
+        ScannerAction.objects.create(
+            registration=self.registration, type="entrance", point=self.point
+        )
+        ScanSeq.objects.create(point=self.point)
+
+        response = self.client.get(
+            reverse("view_code", kwargs={"code": "1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk="})
+            + f"?person=Jill%20Royer&point={self.point.id}"
+        )
+
+        self.assertEqual(
+            [(e["type"], e["point"]) for e in response.json()["events"]],
+            [("scan", "Entrée"), ("scan", None)],
+        )
+
+    def test_get_info_query_count(self):
+        url = (
+            reverse("view_code", kwargs={"code": "1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk="})
+            + f"?person=Jill%20Royer&point={self.point.id}&event={self.event.id}"
+        )
+
+        # the first scan loads the event and its points in the worker cache
+        self.client.get(url)
+
+        # registration with category and event, metas, history, and the
+        # insertion of the scan
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_reset_invalidates_cached_points(self):
+        url = (
+            reverse("view_code", kwargs={"code": "1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk="})
+            + f"?person=Jill%20Royer&point={self.point.id}"
+        )
+        self.client.get(url)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse("reset_point"), data={"point": self.point.id})
+
+        # the cached points are only dropped once the reset is committed
+        self.assertIsNone(points.get_last_reset(self.point.id))
+        for callback in callbacks:
+            callback()
+        response = self.client.get(url)
+
+        self.assertEqual(
+            [(e["type"], e["point"]) for e in response.json()["events"]],
+            [("scan", "Entrée"), ("scan", None)],
+        )
+
+    def test_batch_scan(self):
+        canceled = Registration.objects.create(
+            numero=2,
+            full_name="Other Name",
+            event=self.event,
+            category=self.category,
+            canceled=True,
+        )
+        url = reverse("batch_codes") + f"?person=Jill%20Royer&point={self.point.id}"
+        scans = [
+            {"code": "1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk=", "time": "2022-08-19T19:00:00"},
+            {
+                "code": "1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk=",
+                "time": "2022-08-19T19:00:05",
+                "type": "entrance",
+            },
+            {"code": codes.gen_signed_message(2).decode(), "type": "entrance"},
+            {"code": "1234.Y2VjaQ==", "time": "2022-08-19T19:01:00"},
+        ]
+
+        points.get_point(self.point.id)
+
+        # registrations, then insertion of the actions and update of their
+        # times in a savepoint
+        with self.assertNumQueries(5):
+            response = self.client.post(
+                url, data={"scans": scans}, content_type="application/json"
+            )
+
+        self.assertEqual(
+            [r["result"] for r in response.json()["results"]],
+            ["success", "success", "canceled", "invalid_code"],
+        )
+        self.assertEqual(
+            list(
+                self.registration.events.filter(point=self.point).values_list(
+                    "type", "time__second"
+                )
+            ),
+            [("entrance", 5), ("scan", 0)],
+        )
+        self.assertFalse(canceled.events.exists())
+
+    def test_manifest(self):
+        url = reverse("event_manifest", args=[self.event.id])
+        other = Registration.objects.create(
+            numero=2, full_name="Other Name", event=self.event, category=self.category
+        )
+
+        manifest = json.loads(
+            b"".join(self.client.get(url, {"person": "Jill"}).streaming_content)
+        )
+
+        self.assertEqual(manifest["categories"], {str(self.category.id): "Catégorie"})
+        self.assertEqual(
+            [row[:4] for row in manifest["registrations"]],
+            [
+                [self.registration.id, self.category.id, 0, 0],
+                [other.id, self.category.id, 0, 0],
+            ],
+        )
+        self.assertEqual(
+            manifest["registrations"][0][4],
+            urlsafe_b64encode(
+                sha256(urlsafe_b64decode("Hhv2SqmQwO8UBEwp50X8ZWPbIvk=")).digest()[:9]
+            ).decode(),
+        )
+
+        ScannerAction.objects.create(
+            registration=other, type="entrance", point=self.point
+        )
+        delta = json.loads(
+            b"".join(
+                self.client.get(
+                    url, {"person": "Jill", "since": manifest["version"]}
+                ).streaming_content
+            )
+        )
+
+        # rows modified within the overlap are sent again
+        self.assertEqual(
+            [row[:4] for row in delta["registrations"]],
+            [
+                [self.registration.id, self.category.id, 0, 0],
+                [other.id, self.category.id, 0, 1],
+            ],
+        )
+
+        def get_delta():
+            return [
+                row[:4]
+                for row in json.loads(
+                    b"".join(
+                        self.client.get(
+                            url, {"person": "Jill", "since": delta["version"]}
+                        ).streaming_content
+                    )
+                )["registrations"]
+            ]
+
+        Registration.objects.update(modified=timezone.now() - timedelta(hours=1))
+        self.assertEqual(get_delta(), [])
+
+        # the reset of the point hides the entrance
+        ScanSeq.objects.create(point=self.point)
+        self.assertEqual(get_delta(), [[other.id, self.category.id, 0, 0]])
+
+        ScannerAction.objects.create(registration=self.registration, type="cancel")
+        self.assertEqual(
+            get_delta(),
+            [
+                [self.registration.id, self.category.id, 0, 0],
+                [other.id, self.category.id, 0, 0],
+            ],
+        )
+
+        response = self.client.get(url, {"person": "Jill", "since": "nawak"})
+        self.assertEqual(response.status_code, 400)
+
     def test_can_post_info(self):
         response = self.client.post(
             reverse("view_code", kwargs={"code": "1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk="})
-            + "?person=Jill%20Royer",
+            + f"?person=Jill%20Royer&point={self.point.id}",
             data={"type": "entrance"},
         )
 
@@ -147,7 +491,738 @@ class ViewTestCase(TestCase):
         self.assertEqual(response.status_code, 400)
 
 
+class TicketTestCase(TestCase):
+    def setUp(self):
+        codes._qrcode_png.cache_clear()
+        codes._qrcode_svg.cache_clear()
+        self.media_root = tempfile.TemporaryDirectory()
+        self.enterContext(override_settings(MEDIA_ROOT=self.media_root.name))
+        self.addCleanup(self.media_root.cleanup)
+
+        self.event = TicketEvent.objects.create(
+            name="Événement", send_tickets_until=timezone.now()
+        )
+        self.category = TicketCategory.objects.create(
+            name="Catégorie", color="white", background_color="blue", event=self.event
+        )
+        self.registration = Registration.objects.create(
+            numero=1, full_name="Full Name", event=self.event, category=self.category
+        )
+
+    def set_template(self, template):
+        self.event.ticket_template.save("ticket.svg", ContentFile(template))
+
+    def test_qrcode_as_svg_path(self):
+        self.set_template(
+            b'<svg>{{ full_name }}<path d="{{ qrcode_path }}"/>{{ qrcode_size }}</svg>'
+        )
+
+        svg = tickets.gen_ticket_svg(self.registration)
+
+        qrcode = codes.qrcode_svg(self.registration.pk)
+        self.assertEqual(
+            svg, f'<svg>Full Name<path d="{qrcode.path}"/>{qrcode.size}</svg>'
+        )
+        self.assertEqual(codes._qrcode_png.cache_info().currsize, 0)
+
+    def test_template_is_compiled_once(self):
+        self.set_template(b"<svg>{{ full_name }}</svg>")
+        tickets.gen_ticket_svg(self.registration)
+        template = tickets.get_ticket_template(self.event)
+
+        self.assertIs(tickets.get_ticket_template(self.event), template)
+
+        self.set_template(b"<svg>{{ category }}</svg>")
+        self.assertEqual(
+            tickets.gen_ticket_svg(self.registration), "<svg>Catégorie</svg>"
+        )
+
+    @override_settings(TICKET_RENDER_CONCURRENCY=1)
+    def test_render_pool_timeout(self):
+        pool = render_pool.RenderPool(time.sleep)
+        self.addCleanup(pool.close)
+
+        with self.assertRaises(multiprocessing.TimeoutError):
+            pool.run(30, timeout=0.5)
+
+        # the stuck process is killed and the next conversion gets a new one
+        self.assertIsNone(pool.run(0, timeout=30))
+
+    def test_rendered_tickets_are_cached(self):
+        self.set_template(b"<svg>{{ full_name }} {{ bus }}</svg>")
+
+        with mock.patch.object(
+            tickets, "convert_ticket", side_effect=lambda svg: svg.encode()
+        ) as convert_ticket:
+            self.assertEqual(
+                tickets.gen_ticket(self.registration), b"<svg>Full Name </svg>"
+            )
+            self.assertEqual(
+                tickets.gen_ticket(self.registration), b"<svg>Full Name </svg>"
+            )
+            self.assertEqual(convert_ticket.call_count, 1)
+
+            RegistrationMeta.objects.create(
+                property="bus", value="Lille", registration=self.registration
+            )
+            self.assertEqual(
+                tickets.gen_ticket(self.registration), b"<svg>Full Name Lille</svg>"
+            )
+            self.assertEqual(convert_ticket.call_count, 2)
+
+        self.assertEqual(
+            len(
+                os.listdir(
+                    os.path.join(
+                        self.media_root.name, "tickets", str(self.registration.pk)
+                    )
+                )
+            ),
+            1,
+        )
+
+    def test_store_ticket_replaces_file(self):
+        directory = os.path.join(
+            self.media_root.name, "tickets", str(self.registration.pk)
+        )
+        tickets.store_ticket(self.registration, "key", b"%PDF first")
+        # being written by another worker
+        with open(os.path.join(directory, "other.pdf.tmp"), "wb") as f:
+            f.write(b"%PDF")
+
+        tickets.store_ticket(self.registration, "key", b"%PDF second")
+
+        self.assertEqual(sorted(os.listdir(directory)), ["key.pdf", "other.pdf.tmp"])
+        self.assertEqual(
+            tickets.get_cached_ticket(self.registration, "key"), b"%PDF second"
+        )
+
+    @override_settings(TICKET_COMPRESSION="images", TICKET_IMAGE_MAX_SIZE=100)
+    def test_images_compression(self):
+        big, small = io.BytesIO(), io.BytesIO()
+        Image.new("RGB", (400, 200)).save(big, "JPEG")
+        Image.new("RGB", (50, 50)).save(small, "PNG")
+        small_uri = (
+            "data:image/png;base64," + base64.b64encode(small.getvalue()).decode()
+        )
+        svg = (
+            f'<image href="data:image/jpeg;base64,{base64.b64encode(big.getvalue()).decode()}"/>'
+            f'<image href="{small_uri}"/>'
+        )
+
+        with mock.patch.object(
+            tickets, "svg_to_pdf", lambda svg: svg
+        ), mock.patch.object(tickets, "compress_pdf") as compress_pdf:
+            result = tickets.convert_ticket(svg).decode()
+
+        compress_pdf.assert_not_called()
+        uris = re.findall(r'href="([^"]+)"', result)
+        self.assertEqual(uris[1], small_uri)
+        downsampled = Image.open(io.BytesIO(base64.b64decode(uris[0].split(",")[1])))
+        self.assertEqual(downsampled.size, (100, 50))
+
+    @override_settings(TICKET_IMAGE_MAX_SIZE=100)
+    def test_images_compression_keeps_broken_images(self):
+        image = io.BytesIO()
+        Image.new("RGB", (400, 200)).save(image, "PNG")
+        truncated = (
+            "data:image/png;base64," + base64.b64encode(image.getvalue()[:200]).decode()
+        )
+        svg = f'<image href="{truncated}"/>'
+
+        self.assertEqual(tickets.downsample_images(svg), svg)
+
+        with mock.patch.object(Image, "MAX_IMAGE_PIXELS", 1000):
+            uri = "data:image/png;base64," + base64.b64encode(image.getvalue()).decode()
+            svg = f'<image href="{uri}"/>'
+            self.assertEqual(tickets.downsample_images(svg), svg)
+
+    def test_qrcode_as_png(self):
+        self.set_template(b'<image href="data:image/png;base64,{{ qrcode_data }}"/>')
+
+        svg = tickets.gen_ticket_svg(self.registration)
+
+        png = base64.b64encode(codes.qrcode_png(self.registration.pk)).decode()
+        self.assertEqual(svg, f'<image href="data:image/png;base64,{png}"/>')
+
+    def test_attachments_are_shared(self):
+        TicketAttachment.objects.create(
+            event=self.event,
+            filename="programme.pdf",
+            mimetype="application/pdf",
+            file=ContentFile(b"%PDF programme", name="programme.pdf"),
+        )
+        self.registration.contact_emails = ["a@example.com", "b@example.com"]
+        context = emails.SendContext(self.event)
+
+        with mock.patch.object(
+            emails, "gen_ticket", return_value=b"%PDF"
+        ), mock.patch.object(
+            emails, "gen_event_ics", return_value="ics"
+        ), mock.patch.object(
+            emails,
+            "get_email_template",
+            return_value=email_templates.EmailTemplate("<p></p>", []),
+        ):
+            messages = emails.preparer_billet(self.registration, context=context)
+
+        self.assertEqual(len(messages), 2)
+        for message in messages:
+            self.assertIs(message.attachments[-1], context.attachments.parts[0])
+            self.assertIn('filename="programme.pdf"', message.message().as_string())
+
+    def test_attachment_not_utf8(self):
+        part = emails.AttachmentBundle.mime_part(
+            "liste.csv", "Prénom".encode("latin-1"), "text/csv"
+        )
+        self.assertEqual(part.get_content_type(), "application/octet-stream")
+        self.assertEqual(part.get_payload(decode=True), "Prénom".encode("latin-1"))
+
+        part = emails.AttachmentBundle.mime_part(
+            "liste.csv", "Prénom".encode(), "text/csv"
+        )
+        self.assertEqual(part.get_content_type(), "text/csv")
+        self.assertEqual(part.get_payload(decode=True).decode(), "Prénom")
+
+    def test_event_ics_skeleton(self):
+        self.event.start_date = timezone.now()
+        self.event.end_date = timezone.now()
+        skeleton = tickets.gen_event_ics_skeleton(self.event)
+
+        for numero in ("1", "a,b;c", "x" * 100):
+            self.registration.numero = numero
+            calendar = Calendar.from_ical(
+                tickets.gen_event_ics(self.registration, skeleton)
+            )
+            self.assertEqual(calendar.walk("VEVENT")[0]["UID"], numero)
+
+    def test_ticket_sender(self):
+        registrations = [self.registration] + [
+            Registration.objects.create(
+                numero=numero,
+                full_name="Full Name",
+                event=self.event,
+                category=self.category,
+            )
+            for numero in (2, 3)
+        ]
+
+        def preparer_billet(registration, context):
+            if registration.numero == 2:
+                raise RuntimeError("rendering failed")
+            message = mail.EmailMessage(
+                f"Billet {registration.numero}", "", to=["test@example.com"]
+            )
+            if registration.numero == 3:
+                message.send = mock.Mock(
+                    side_effect=SMTPRecipientsRefused({"test@example.com": ()})
+                )
+            return [message]
+
+        sender = sending.TicketSender(concurrency=2, smtp_workers=2)
+        with mock.patch.object(sending, "preparer_billet", preparer_billet):
+            results = {
+                registration.numero: result
+                for registration, result, exception in sender.send(registrations)
+            }
+
+        self.assertEqual(
+            results,
+            {
+                1: sending.RESULT_SENT,
+                2: sending.RESULT_ERROR,
+                3: sending.RESULT_REFUSED,
+            },
+        )
+        self.assertEqual([m.subject for m in mail.outbox], ["Billet 1"])
+
+    def test_smtp_connections_opened_once_per_worker(self):
+        registrations = [self.registration] + [
+            Registration.objects.create(
+                numero=numero,
+                full_name="Full Name",
+                event=self.event,
+                category=self.category,
+            )
+            for numero in range(2, 6)
+        ]
+        connections = []
+
+        def get_connection():
+            connections.append(mock.Mock())
+            return connections[-1]
+
+        def preparer_billet(registration, context):
+            return [mail.EmailMessage("Billet", "", to=["test@example.com"])]
+
+        sender = sending.TicketSender(concurrency=2, smtp_workers=2)
+        with mock.patch.object(
+            sending, "preparer_billet", preparer_billet
+        ), mock.patch.object(sending, "get_connection", get_connection):
+            results = [result for _, result, _ in sender.send(registrations)]
+
+        self.assertEqual(results, [sending.RESULT_SENT] * 5)
+        self.assertEqual(len(connections), 2)
+        for connection in connections:
+            connection.open.assert_called_once_with()
+            connection.close.assert_called_once_with()
+        self.assertEqual(
+            sum(connection.send_messages.call_count for connection in connections), 5
+        )
+
+    def test_interrupted_send_job(self):
+        for numero in range(2, 41):
+            Registration.objects.create(
+                numero=numero,
+                full_name="Full Name",
+                event=self.event,
+                category=self.category,
+            )
+
+        def preparer_billet(registration, context):
+            return [mail.EmailMessage("Billet", "", to=["test@example.com"])]
+
+        job = sending.create_job(self.event)
+        runner = sending.JobRunner(
+            job, sending.TicketSender(concurrency=4, smtp_workers=1)
+        )
+        with mock.patch.object(sending, "preparer_billet", preparer_billet):
+            results = runner.run()
+            next(results)
+            results.close()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, SendJob.STATUS_STOPPED)
+        self.assertLess(len(mail.outbox), 40)
+        self.assertEqual(job.sent, len(mail.outbox))
+        self.assertEqual(
+            Registration.objects.filter(ticket_status=Registration.TICKET_SENT).count(),
+            len(mail.outbox),
+        )
+
+        # the tickets sent are not sent again when resuming
+        with mock.patch.object(sending, "preparer_billet", preparer_billet):
+            list(
+                sending.JobRunner(
+                    job, sending.TicketSender(concurrency=4, smtp_workers=1)
+                ).run()
+            )
+        self.assertEqual(len(mail.outbox), 40)
+
+    def test_send_job_resume(self):
+        for numero in (2, 3):
+            Registration.objects.create(
+                numero=numero,
+                full_name="Full Name",
+                event=self.event,
+                category=self.category,
+            )
+        failing = {"2"}
+
+        def preparer_billet(registration, context):
+            if registration.numero in failing:
+                raise RuntimeError("rendering failed")
+            return [
+                mail.EmailMessage(
+                    f"Billet {registration.numero}", "", to=["test@example.com"]
+                )
+            ]
+
+        job = sending.create_job(self.event)
+        self.assertEqual(job.total, 3)
+
+        with mock.patch.object(sending, "preparer_billet", preparer_billet):
+            list(sending.JobRunner(job, sending.TicketSender()).run())
+
+            job.refresh_from_db()
+            self.assertEqual((job.sent, job.refused, job.errors), (2, 0, 1))
+            self.assertEqual(job.status, SendJob.STATUS_DONE)
+            self.assertEqual(
+                set(
+                    Registration.objects.filter(
+                        ticket_status=Registration.TICKET_SENT
+                    ).values_list("numero", flat=True)
+                ),
+                {"1", "3"},
+            )
+            self.assertEqual(
+                list(
+                    sending.remaining_registrations(job).values_list(
+                        "numero", flat=True
+                    )
+                ),
+                ["2"],
+            )
+
+            failing.clear()
+            list(sending.JobRunner(job, sending.TicketSender()).run())
+
+        job.refresh_from_db()
+        self.assertEqual((job.sent, job.refused, job.errors), (3, 0, 0))
+        self.assertEqual(job.cursor, Registration.objects.get(numero="3").pk)
+        self.assertEqual(
+            [m.subject for m in mail.outbox], ["Billet 1", "Billet 3", "Billet 2"]
+        )
+
+
+class SendTicketsCommandTestCase(TestCase):
+    def setUp(self):
+        self.event = TicketEvent.objects.create(
+            name="Événement", send_tickets_until=timezone.now() + timedelta(days=1)
+        )
+        category = TicketCategory.objects.create(
+            name="Catégorie", color="white", background_color="blue", event=self.event
+        )
+        for numero in ("1", "2"):
+            Registration.objects.create(
+                numero=numero,
+                full_name="Full Name",
+                event=self.event,
+                category=category,
+            )
+
+    def send_tickets(self, *args, failing=()):
+        def preparer_billet(registration, context):
+            if registration.numero in failing:
+                raise RuntimeError("rendering failed")
+            return [
+                mail.EmailMessage(
+                    f"Billet {registration.numero}", "", to=["test@example.com"]
+                )
+            ]
+
+        with mock.patch.object(sending, "preparer_billet", preparer_billet):
+            call_command("send_tickets", *args, stdout=io.StringIO())
+
+    def test_resume_retries_errors(self):
+        self.send_tickets(str(self.event.id), failing={"2"})
+        job = SendJob.objects.get()
+        self.assertEqual(job.status, SendJob.STATUS_DONE)
+        self.assertEqual((job.sent, job.errors), (1, 1))
+
+        self.send_tickets("--resume", str(job.id))
+        job.refresh_from_db()
+        self.assertEqual((job.sent, job.errors), (2, 0))
+        self.assertEqual([m.subject for m in mail.outbox], ["Billet 1", "Billet 2"])
+
+        with self.assertRaisesMessage(CommandError, "Job is already done"):
+            self.send_tickets("--resume", str(job.id))
+
+
+class EmailTemplateTestCase(TestCase):
+    def setUp(self):
+        email_templates.clear_cache()
+        self.addCleanup(email_templates.clear_cache)
+
+    def response(self, status_code=200, content=b"", etag=None):
+        response = mock.Mock(status_code=status_code, content=content)
+        response.headers = {"ETag": etag} if etag else {}
+        return response
+
+    def test_template_fetched_once_and_rendered_locally(self):
+        html = "<p>__SCANNER_FULL_NAME__ <a href='__SCANNER_QR_CODE__'></a></p>"
+        with mock.patch.object(
+            email_templates.http,
+            "get",
+            return_value=self.response(content=html.encode(), etag='"v1"'),
+        ) as get:
+            for name in ("Jean", "Marie & Paul"):
+                template = email_templates.get_email_template(
+                    "http://mosaico/template", ["FULL_NAME", "EMAIL", "QR_CODE"]
+                )
+                rendered = template.render({"FULL_NAME": name, "QR_CODE": "cid:abc"})
+
+        get.assert_called_once_with(
+            "http://mosaico/template",
+            "email_template",
+            params={
+                "FULL_NAME": "__SCANNER_FULL_NAME__",
+                "EMAIL": "__SCANNER_EMAIL__",
+                "QR_CODE": "__SCANNER_QR_CODE__",
+            },
+            headers={},
+        )
+        self.assertEqual(rendered, "<p>Marie &amp; Paul <a href='cid:abc'></a></p>")
+        self.assertTrue(template.uses("QR_CODE"))
+        self.assertFalse(template.uses("EMAIL"))
+
+    @override_settings(EMAIL_TEMPLATE_TTL=0)
+    def test_template_revalidated_with_etag(self):
+        names = ["FULL_NAME"]
+        with mock.patch.object(email_templates.http, "get") as get:
+            get.return_value = self.response(
+                content=b"__SCANNER_FULL_NAME__", etag='"v1"'
+            )
+            template = email_templates.get_email_template("http://mosaico/", names)
+
+            get.return_value = self.response(status_code=304)
+            self.assertIs(
+                email_templates.get_email_template("http://mosaico/", names), template
+            )
+            self.assertEqual(get.call_args.kwargs["headers"], {"If-None-Match": '"v1"'})
+
+            get.side_effect = requests.ConnectionError
+            self.assertIs(
+                email_templates.get_email_template("http://mosaico/", names), template
+            )
+
+    @override_settings(HTTP_CONNECT_TIMEOUT=1, HTTP_READ_TIMEOUT=2)
+    def test_http_client(self):
+        adapter = http.get_session().get_adapter("https://mosaico/")
+        self.assertEqual(adapter.max_retries.total, settings.HTTP_RETRIES)
+
+        def count():
+            return (
+                REGISTRY.get_sample_value(
+                    "scanner_http_request_duration_seconds_count",
+                    {"target": "test", "status": "200"},
+                )
+                or 0
+            )
+
+        before = count()
+        with mock.patch.object(
+            http.get_session(), "get", return_value=self.response()
+        ) as get:
+            http.get("https://mosaico/", "test")
+
+        get.assert_called_once_with("https://mosaico/", timeout=(1, 2))
+        self.assertEqual(count(), before + 1)
+
+
+class GoogleWalletTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.key_file = os.path.join(self.directory.name, "gce.json")
+        self.enterContext(override_settings(GCE_KEY_FILE=self.key_file))
+        self.public_key = self.write_key("wallet@example.iam.gserviceaccount.com")
+
+        event = TicketEvent.objects.create(
+            name="Événement",
+            send_tickets_until=timezone.now(),
+            google_wallet_class_id="class",
+        )
+        category = TicketCategory.objects.create(
+            name="Catégorie", color="white", background_color="blue", event=event
+        )
+        self.registrations = [
+            Registration.objects.create(
+                numero=numero, full_name="Full Name", event=event, category=category
+            )
+            for numero in ("1", "2")
+        ]
+
+    def write_key(self, email):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        with open(self.key_file, "w") as f:
+            json.dump({"client_email": email, "private_key": pem.decode()}, f)
+        return private_key.public_key()
+
+    def decode(self, url):
+        token = url.removeprefix("https://pay.google.com/gp/v/save/")
+        return jwt.decode(
+            token, self.public_key, algorithms=["RS256"], audience="google"
+        )
+
+    def test_signer_is_cached_and_reloaded(self):
+        signer = wallet.get_google_wallet_signer()
+        self.assertIs(wallet.get_google_wallet_signer(), signer)
+
+        self.public_key = self.write_key("other@example.iam.gserviceaccount.com")
+        signer = wallet.get_google_wallet_signer()
+        self.assertEqual(
+            signer.service_account_email, "other@example.iam.gserviceaccount.com"
+        )
+        payload = self.decode(self.registrations[0].google_wallet_url)
+        self.assertEqual(payload["iss"], "other@example.iam.gserviceaccount.com")
+
+    def test_url(self):
+        signer = wallet.get_google_wallet_signer()
+
+        for registration in self.registrations:
+            objects = self.decode(registration.get_google_wallet_url(signer))[
+                "payload"
+            ]["eventTicketObjects"]
+            self.assertEqual(objects, [registration.google_wallet_object()])
+
+    def test_group_urls(self):
+        for registration in self.registrations:
+            registration.contact_emails = ["family@example.com"]
+            registration.save()
+        other = Registration.objects.create(
+            numero="3",
+            full_name="Other Name",
+            event=self.registrations[0].event,
+            category=self.registrations[0].category,
+            _contact_emails="other@example.com,Family@example.com",
+        )
+
+        context = emails.SendContext(other.event)
+        self.assertEqual(
+            context.contact_email_groups,
+            {
+                "family@example.com": [*(r.pk for r in self.registrations), other.pk],
+                "other@example.com": [other.pk],
+            },
+        )
+        objects = self.decode(context.google_wallet_url(other, "Family@example.com"))[
+            "payload"
+        ]["eventTicketObjects"]
+        self.assertEqual([o["ticketNumber"] for o in objects], ["1", "2", "3"])
+
+        context = emails.SendContext(other.event)
+        with mock.patch.object(
+            wallet.GoogleWalletSigner, "save_url", autospec=True, return_value="url"
+        ) as save_url:
+            links = {
+                context.google_wallet_url(registration, "family@example.com")
+                for registration in [*self.registrations, other]
+            }
+        self.assertEqual(links, {"url"})
+        save_url.assert_called_once()
+
+
+class ApplePassSignerTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.p12_path = os.path.join(self.directory.name, "pass.p12")
+        self.wwdr_path = os.path.join(self.directory.name, "wwdr.pem")
+        self.enterContext(
+            override_settings(
+                APPLE_PASS_CERT_PATH=self.p12_path,
+                APPLE_CERTIFICATE_PASSWORD="password",
+                APPLE_WWDR_CERT=self.wwdr_path,
+            )
+        )
+
+        key, self.certificate = self_signed_certificate("Pass Type ID")
+        with open(self.p12_path, "wb") as f:
+            f.write(
+                pkcs12.serialize_key_and_certificates(
+                    b"pass",
+                    key,
+                    self.certificate,
+                    None,
+                    serialization.BestAvailableEncryption(b"password"),
+                )
+            )
+        self.wwdr = self_signed_certificate("WWDR")[1]
+        with open(self.wwdr_path, "wb") as f:
+            f.write(self.wwdr.public_bytes(serialization.Encoding.PEM))
+
+    def test_signature_includes_wwdr(self):
+        signer = wallet.get_apple_pass_signer()
+        self.assertIs(wallet.get_apple_pass_signer(), signer)
+
+        signature = signer.sign(b'{"pass.json": "abc"}')
+        self.assertCountEqual(
+            pkcs7.load_der_pkcs7_certificates(signature),
+            [self.certificate, self.wwdr],
+        )
+
+    def test_generate_wallet_pass(self):
+        self.enterContext(override_settings(MEDIA_ROOT=self.directory.name))
+        logo = io.BytesIO()
+        Image.new("RGB", (10, 10), "blue").save(logo, "PNG")
+
+        event = TicketEvent.objects.create(
+            name="Événement",
+            send_tickets_until=timezone.now(),
+            start_date=timezone.now(),
+            end_date=timezone.now(),
+            wallet_logo=ContentFile(logo.getvalue(), name="logo.png"),
+        )
+        category = TicketCategory.objects.create(
+            name="Catégorie", color="white", background_color="blue", event=event
+        )
+        registration = Registration.objects.create(
+            numero="1", full_name="Full Name", event=event, category=category
+        )
+
+        self.assertIs(wallet.get_pass_images(event), wallet.get_pass_images(event))
+
+        passes = os.path.join(self.directory.name, "wallet_passes")
+        self.assertTrue(registration.generate_wallet_pass())
+        self.assertFalse(registration.generate_wallet_pass())
+        [first] = os.listdir(passes)
+        self.assertTrue(first.startswith("ticket_1_"))
+
+        registration.full_name = "Other Name"
+        self.assertTrue(registration.generate_wallet_pass())
+        self.assertNotIn(first, os.listdir(passes))
+        self.assertEqual(len(os.listdir(passes)), 1)
+
+        # the storage may give the file another name than the one asked
+        renamed = registration.wallet_pass.name.replace(".pkpass", "_abc123.pkpass")
+        os.rename(
+            os.path.join(self.directory.name, registration.wallet_pass.name),
+            os.path.join(self.directory.name, renamed),
+        )
+        registration.wallet_pass.name = renamed
+        self.assertFalse(registration.generate_wallet_pass())
+
+        with registration.wallet_pass.open("rb") as f:
+            archive = zipfile.ZipFile(io.BytesIO(f.read()))
+        files = {name: archive.read(name) for name in archive.namelist()}
+        manifest = json.loads(files.pop("manifest.json"))
+        files.pop("signature")
+        self.assertEqual(
+            manifest,
+            {
+                name: hashlib.sha1(content).hexdigest()
+                for name, content in files.items()
+            },
+        )
+        self.assertEqual(set(files), {"pass.json", "logo.png", "icon.png"})
+        self.assertEqual(
+            json.loads(files["pass.json"])["serialNumber"],
+            registration.wallet_pass_serial,
+        )
+
+        # the pass is not built for the link, but at the first download
+        other = Registration.objects.create(
+            numero="2", full_name="Full Name", event=event, category=category
+        )
+        url = other.apple_wallet_url
+        self.assertEqual(len(os.listdir(passes)), 1)
+        response = self.client.get(url)
+        self.assertEqual(response["Content-Type"], "application/vnd.apple.pkpass")
+        self.assertEqual(len(os.listdir(passes)), 2)
+
+    @skipUnless(shutil.which("openssl"), "openssl is not installed")
+    def test_signature_verifies(self):
+        manifest = os.path.join(self.directory.name, "manifest.json")
+        with open(manifest, "wb") as f:
+            f.write(b'{"pass.json": "abc"}')
+
+        for signer in (
+            wallet.get_apple_pass_signer(),
+            OpenSSLApplePassSigner(self.p12_path, "password", self.wwdr_path),
+        ):
+            signature = os.path.join(self.directory.name, "signature")
+            with open(signature, "wb") as f:
+                f.write(signer.sign(b'{"pass.json": "abc"}'))
+
+            subprocess.run(
+                ["openssl", "smime", "-verify", "-binary", "-noverify"]
+                + ["-inform", "DER", "-in", signature, "-content", manifest],
+                check=True,
+                capture_output=True,
+            )
+
+
 class SignatureTestCase(TestCase):
+    def setUp(self):
+        codes._qrcode_png.cache_clear()
+        codes._qrcode_svg.cache_clear()
+
     def test_raise_on_wrong_codes(self):
         wrong_codes = [
             "jzdaz_dhuidza",  # no point
@@ -165,3 +1240,60 @@ class SignatureTestCase(TestCase):
     @override_settings(SIGNATURE_KEY=b"prout")
     def test_get_id(self):
         self.assertEqual(codes.get_id_from_code("1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk="), 1)
+
+    @override_settings(SIGNATURE_KEY=b"nouvelle", SIGNATURE_OLD_KEYS=[b"prout"])
+    def test_key_rotation(self):
+        self.assertEqual(codes.get_id_from_code("1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk="), 1)
+
+        new_code = codes.gen_signed_message(1).decode()
+        self.assertNotEqual(new_code, "1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk=")
+        self.assertEqual(codes.get_id_from_code(new_code), 1)
+
+        with override_settings(SIGNATURE_OLD_KEYS=[]):
+            with self.assertRaises(codes.InvalidCodeException):
+                codes.get_id_from_code("1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk=")
+
+    def test_qrcode_png_is_cached(self):
+        with tempfile.TemporaryDirectory() as media_root:
+            with override_settings(MEDIA_ROOT=media_root, QRCODE_DISK_CACHE=True):
+                png = codes.qrcode_png(123456)
+                self.assertTrue(png.startswith(b"\x89PNG"))
+                self.assertIs(codes.qrcode_png(123456), png)
+
+                stored = os.listdir(os.path.join(media_root, "qrcodes"))
+                self.assertEqual(len(stored), 1)
+
+                codes._qrcode_png.cache_clear()
+                self.assertEqual(codes.qrcode_png(123456), png)
+
+    def test_qrcode_svg(self):
+        svg = codes.qrcode_svg(1)
+        self.assertEqual(svg.size, codes.gen_qrcode(1).pixel_size // 10)
+        self.assertTrue(svg.path.startswith("M0,0"))
+
+    @override_settings(SIGNATURE_KEY=b"prout")
+    def test_verify_codes(self):
+        wallet_code = urlsafe_b64encode(b"1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk").decode()
+        valid, rejected = codes.verify_codes(
+            [
+                "1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk=",
+                wallet_code,
+                "jzdaz_dhuidza",
+                "oizefjie.ize.daz",
+                "jio.jifezf",
+                "1234.abcde",
+                "1234.Y2VjaQ==",
+            ]
+        )
+
+        self.assertEqual(valid, {"1.Hhv2SqmQwO8UBEwp50X8ZWPbIvk=": 1, wallet_code: 1})
+        self.assertEqual(
+            rejected,
+            {
+                "jzdaz_dhuidza": codes.REASON_FORMAT,
+                "oizefjie.ize.daz": codes.REASON_FORMAT,
+                "jio.jifezf": codes.REASON_IDENTIFIER,
+                "1234.abcde": codes.REASON_BASE64,
+                "1234.Y2VjaQ==": codes.REASON_SIGNATURE,
+            },
+        )
@@ -1,17 +1,34 @@
+import json
+
 from django.core.exceptions import PermissionDenied
-from django.db.models import Q, F, Max
-from django.http import FileResponse, JsonResponse, HttpResponse, HttpResponseBadRequest, Http404
+from django.http import (
+    FileResponse,
+    JsonResponse,
+    HttpResponse,
+    HttpResponseBadRequest,
+    Http404,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404
 from django.core.files.storage import default_storage
 from django.views import View
 from django.views.generic import CreateView
 import subprocess
 
-from .models import Registration, ScannerAction, ScanPoint, ScanSeq, TicketEvent
-from .actions.scans import scan_code, mark_registration, InvalidCodeException
+from .models import Registration, ScannerAction, ScanSeq
+from .actions import points
+from .actions.manifest import gen_manifest
+from .actions.scans import (
+    scan_code,
+    scan_codes,
+    mark_registration,
+    InvalidCodeException,
+)
+
+MAX_BATCH_SIZE = 1000
 
 
-class CodeView(View):
+class ScanParamsMixin:
     def get_person(self):
         person = self.request.GET.get("person")
 
@@ -20,29 +37,37 @@ class CodeView(View):
 
         return person
 
-    def get_event(self):
+    def get_id_param(self, name):
         try:
-            TicketEvent.objects.get(id=self.request.GET.get("event"))
-        except (TicketEvent.DoesNotExist, ValueError, TypeError):
+            return int(self.request.GET.get(name))
+        except (ValueError, TypeError):
             return None
-        
+
+    def get_event(self):
+        event_id = self.get_id_param("event")
+        if event_id is None:
+            return None
+        return points.get_event(event_id)
 
     def get_point(self):
-        try:
-            return ScanPoint.objects.get(id=self.request.GET.get("point"))
-        except (ScanPoint.DoesNotExist, ValueError, TypeError):
-            points = ScanPoint.objects.get(event__id=self.request.GET.get("event"))
-            if points:
-                return points.first()
+        point_id = self.get_id_param("point")
+        if point_id is not None and (point := points.get_point(point_id)):
+            return point
+
+        event_id = self.get_id_param("event")
+        if event_id is None:
             return None
+        return next(iter(points.get_event_points(event_id)), None)
 
+
+class CodeView(ScanParamsMixin, View):
     def get(self, request, code):
         person = self.get_person()
         point = self.get_point()
         event = self.get_event()
 
         try:
-            registration = scan_code(code, person, point, event)
+            registration = scan_code(code, person, event, point)
         except InvalidCodeException:
             raise Http404
 
@@ -58,9 +83,7 @@ class CodeView(View):
                     "color": registration.category.color,
                     "background-color": registration.category.background_color,
                 },
-                "meta": dict(
-                    [(meta.property, meta.value) for meta in registration.metas.all()]
-                ),
+                "meta": registration.meta_values,
                 "events": [
                     {
                         "id": event.id,
@@ -69,9 +92,7 @@ class CodeView(View):
                         "person": event.person,
                         "point": event.point.name if event.point is not None else None,
                     }
-                    for event in registration.events.annotate(
-                        last_seq=Max("point__seqs__created")
-                    ).filter(Q(last_seq=None) | Q(last_seq__lt=F("time")))
+                    for event in registration.scan_history
                 ],
             }
         )
@@ -90,11 +111,51 @@ class CodeView(View):
         try:
             mark_registration(code, type, person, point)
         except InvalidCodeException:
-            return Http404
+            raise Http404
 
         return HttpResponse("OK")
 
 
+class BatchCodeView(ScanParamsMixin, View):
+    """Replay the scans queued by a device while it was offline"""
+
+    def post(self, request):
+        person = self.get_person()
+        point = self.get_point()
+
+        try:
+            scans = json.loads(request.body)["scans"]
+        except (ValueError, KeyError, TypeError):
+            return HttpResponseBadRequest()
+
+        if (
+            not isinstance(scans, list)
+            or len(scans) > MAX_BATCH_SIZE
+            or not all(isinstance(scan, dict) for scan in scans)
+        ):
+            return HttpResponseBadRequest()
+
+        return JsonResponse({"results": scan_codes(scans, person, point)})
+
+
+class ManifestView(ScanParamsMixin, View):
+    """Snapshot of an event tickets, or its changes since a given version"""
+
+    def get(self, request, event_id):
+        self.get_person()
+        event = points.get_event(event_id)
+
+        if event is None:
+            raise Http404
+
+        try:
+            chunks = gen_manifest(event, since=request.GET.get("since"))
+        except ValueError:
+            return HttpResponseBadRequest()
+
+        return StreamingHttpResponse(chunks, content_type="application/json")
+
+
 class CreateSeqView(CreateView):
     model = ScanSeq
     fields = ("point",)
@@ -111,9 +172,9 @@ class DownloadWalletPassView(View):
             wallet_token=token
         )
         
-        if not registration.wallet_pass:
-            registration.generate_wallet_pass()
-        
+        # built at the first download, then only when its data changes
+        registration.generate_wallet_pass()
+
         if registration.wallet_pass:
             response = FileResponse(
                 registration.wallet_pass.open('rb'),
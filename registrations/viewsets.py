@@ -7,7 +7,7 @@ from registrations.serializers import RegistrationSerializer, EventSerializer
 
 
 class RegistrationViewSet(viewsets.ModelViewSet):
-    queryset = Registration.objects.all()
+    queryset = Registration.objects.prefetch_related("metas")
     serializer_class = RegistrationSerializer
     filter_backends = (DjangoFilterBackend,)
     filter_fields = ("event", "uuid")
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+import tempfile
 
 import dj_email_url
 
@@ -27,6 +28,10 @@ SECRET_KEY = os.environ.get(
     "SECRET", "1d5a5&y9(220)phk0o9cqjwdpm$3+**d&+kru(2y)!5h-_qn4b"
 )
 SIGNATURE_KEY = os.environb.get(b"SIGNATURE_KEY", b"prout")
+# former signature keys, codes signed with them are still accepted
+SIGNATURE_OLD_KEYS = [
+    key for key in os.environb.get(b"SIGNATURE_OLD_KEYS", b"").split(b",") if key
+]
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.environ.get("DEBUG", "true").lower() == "true"
@@ -93,6 +98,19 @@ DATABASES = {
     }
 }
 
+# Cache shared by the workers of the host, which the scan metadata cache relies
+# on to invalidate the copies of the other workers
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get(
+            "CACHE_BACKEND", "django.core.cache.backends.filebased.FileBasedCache"
+        ),
+        "LOCATION": os.environ.get(
+            "CACHE_LOCATION", os.path.join(tempfile.gettempdir(), "scanner-cache")
+        ),
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -130,6 +148,12 @@ STATIC_ROOT = os.environ.get("STATIC_ROOT")
 # Private files
 MEDIA_ROOT = os.environ.get("MEDIA_ROOT", "media")
 MEDIA_URL = '/media/'
+# store the rendered QR codes under MEDIA_ROOT/qrcodes
+QRCODE_DISK_CACHE = os.environ.get("QRCODE_DISK_CACHE", "").lower() in [
+    "y",
+    "yes",
+    "true",
+]
 DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
 
 email_config = dj_email_url.parse(os.environ.get("SMTP_URL", "smtp://localhost:1025/"))
@@ -144,6 +168,8 @@ EMAIL_USE_TLS = email_config["EMAIL_USE_TLS"]
 EMAIL_USE_SSL = email_config["EMAIL_USE_SSL"]
 
 EMAIL_FROM = os.environ.get("EMAIL_FROM", "tickets@lafranceinsoumise.fr")
+# seconds before a fetched email template is revalidated against its server
+EMAIL_TEMPLATE_TTL = int(os.environ.get("EMAIL_TEMPLATE_TTL", 300))
 
 LOG_DISABLE_JOURNALD = os.environ.get("LOG_DISABLE_JOURNALD", "").lower() in [
     "y",
@@ -191,4 +217,32 @@ APPLE_PRIVATE_KEY_PATH = os.environ.get("APPLE_PRIVATE_KEY", "./private.key")
 APPLE_CERTIFICATE_PASSWORD = os.environ.get("APPLE_CERT_PW", "")
 APPLE_WWDR_CERT = os.environ.get("APPLE_WWDR_CERT", "./pass.pem")
 APPLE_PASS_TYPE_ID = "pass.fr.scanner.franceinsoumise.org"
-APPLE_TEAM_ID = os.environ.get("APPLE_TEAM_ID", "")
\ No newline at end of file
+APPLE_TEAM_ID = os.environ.get("APPLE_TEAM_ID", "")
+
+# Tickets generation
+# "rsvg" runs rsvg-convert, "cairosvg" renders in process (poetry install -E cairosvg)
+TICKET_RENDERER = os.environ.get("TICKET_RENDERER", "rsvg")
+# tickets rendered in parallel when sending them, unless send_tickets -j is given
+TICKET_RENDER_CONCURRENCY = int(
+    os.environ.get("TICKET_RENDER_CONCURRENCY", os.cpu_count() or 1)
+)
+# "gs" compresses the PDF with Ghostscript, "images" downsamples the embedded
+# images to TICKET_IMAGE_MAX_SIZE pixels before the conversion, "none" does not
+# compress at all
+TICKET_COMPRESSION = os.environ.get("TICKET_COMPRESSION", "gs")
+TICKET_IMAGE_MAX_SIZE = int(os.environ.get("TICKET_IMAGE_MAX_SIZE", 1200))
+# keep rendered tickets in the default storage, under tickets/
+TICKET_CACHE = os.environ.get("TICKET_CACHE", "true").lower() in [
+    "y",
+    "yes",
+    "true",
+]
+
+# Outbound HTTP requests (email templates)
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 10))
+
+# Scan endpoint
+SCAN_CACHE_TTL = int(os.environ.get("SCAN_CACHE_TTL", 60))
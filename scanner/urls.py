@@ -18,7 +18,13 @@ from django.urls import path, include
 from django.views.decorators.csrf import csrf_exempt
 
 from registrations.router import router
-from registrations.views import CodeView, CreateSeqView, DownloadWalletPassView
+from registrations.views import (
+    BatchCodeView,
+    CodeView,
+    CreateSeqView,
+    DownloadWalletPassView,
+    ManifestView,
+)
 from .metrics import get_metrics
 from scanner import settings
 from django.conf.urls.static import static
@@ -26,6 +32,12 @@ from django.conf.urls.static import static
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("code/<code>/", csrf_exempt(CodeView.as_view()), name="view_code"),
+    path("codes/", csrf_exempt(BatchCodeView.as_view()), name="batch_codes"),
+    path(
+        "events/<int:event_id>/manifest/",
+        ManifestView.as_view(),
+        name="event_manifest",
+    ),
     path("reset/", csrf_exempt(CreateSeqView.as_view()), name="reset_point"),
     path("metrics/", get_metrics),
     path("api/", include(router.urls)),